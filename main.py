@@ -2,6 +2,7 @@ import numpy as np
 import random
 import copy
 import argparse
+import sbg
 
 
 # by default runs the example "Optimal Robots can be Fully Opaque"
@@ -9,6 +10,7 @@ import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument('--example', default="fully",
                     help='options are fully and rationally')
+parser.add_argument('--solver', default="numpy", help='options are numpy and loop')
 args = parser.parse_args()
 
 
@@ -22,12 +24,10 @@ class ExampleSBG:
         self.T = 5
         # augmented state space
         # (timestep t, state s, belief b)
-        self.states = []
-        for t in range(self.T):
-            for s in np.linspace(0, 2.0, 21):
-                for b in np.linspace(0, 1.0, 11):
-                    augmented_state = (t, round(s,1), round(b,1))
-                    self.states.append(augmented_state)
+        # the states are ranked implicitly instead of stored, see sbg.StateSpace
+        positions = sbg.grid(0, 2.0, 21)
+        beliefs = sbg.grid(0, 1.0, 11)
+        self.states = sbg.StateSpace([(positions, beliefs)] * self.T)
         # action space
         # action space for the confused robot
         self.actions_r1 = [-0.1]
@@ -68,9 +68,13 @@ class ExampleSBG:
     def value_iteration(self):
         V1 = {s: 0 for s in self.states}
         pi = {s: None for s in self.states}
-        for _ in range(self.T+1):
-            V = V1.copy()
-            for s in self.states:
+        # the horizon is finite and f always moves to the next timestep,
+        # so one backward pass over the timestep layers is enough
+        layers = {}
+        for s in self.states:
+            layers.setdefault(s[0], []).append(s)
+        for t in sorted(layers, reverse=True):
+            for s in layers[t]:
                 if s[0] == self.T-1:
                     V1[s] = self.reward(s)
                     continue
@@ -80,14 +84,19 @@ class ExampleSBG:
                         for ar2 in self.actions_r2:
                             s1 = self.f(s, ah, ar1)
                             s2 = self.f(s, ah, ar2)
-                            eV1 = (1-s[2]) * V[s1]
-                            eV2 = s[2] * V[s2]
+                            eV1 = (1-s[2]) * V1[s1]
+                            eV2 = s[2] * V1[s2]
                             if eV1 + eV2 > v_next_max:
                                 v_next_max = eV1 + eV2
                                 pi[s] = [ah, ar1, ar2]
                 V1[s] = self.reward(s) + v_next_max
         return pi, V1
 
+    # same as value_iteration, but backs up each timestep layer at once with numpy
+    # the dynamics do not depend on t, so f is only called on the first layer
+    def value_iteration_vectorized(self):
+        return sbg.value_iteration_vectorized(self, sbg.pure_step(self), belief=2)
+
 
 # rollout the human and robot behavior starting at augmented state
 # prints the team state and the human's belief
@@ -122,7 +131,10 @@ def main():
 
     # get optimal policy for human and robot
     block1d = ExampleSBG()
-    pi, V = block1d.value_iteration()
+    if args.solver == "loop":
+        pi, V = block1d.value_iteration()
+    else:
+        pi, V = block1d.value_iteration_vectorized()
 
     print("[*] Confused Robot with Rational Human")
     rollout_team(augmented_state, pi, block1d, "confused", "rational")
@@ -0,0 +1,211 @@
+'''
+Local server for the policies of the user studies.
+It maps a policy file once (saved with --export by userstudy2_blocks.py or
+the userstudy1 scripts, see sbg.PolicyTable) and answers batches of
+augmented states with their joint actions, over a UNIX socket or a localhost
+port, to any number of clients at once, e.g. the robot arm and simulated
+participants.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import time
+from collections import deque
+import numpy as np
+import sbg
+
+
+# for instance, python policy_server.py --policy pi.bin --socket /tmp/sbg.sock
+parser = argparse.ArgumentParser()
+parser.add_argument('--policy', required=True, help='policy file saved with --export')
+parser.add_argument('--socket', default=None, help='listen on this UNIX socket instead of a localhost port')
+parser.add_argument('--port', type=int, default=8765, help='localhost port, if there is no --socket')
+parser.add_argument('--window', type=int, default=100000, help='number of recent requests in the latency counters')
+parser.add_argument('--max-batch', type=int, default=4096, help='most states in one request, larger requests close the connection')
+
+
+# protocol, everything is little endian
+# on connect the server sends MAGIC, the width w of the states (uint32) and
+# the length of a json header (uint32), then the header with the action sets
+# a request is the number of states n (uint32) and n*w float64, the states
+# flattened as in sbg.PolicyTable, e.g. (t, blocks..., b) for the tower with
+# -1 in the empty slots, or (t, x, y, b) for parking
+# the reply is n int32, the index k of the joint action of each state, with
+# (ah, ar1, ar2) = (actions_h[k // (n1*n2)], actions_r1[k // n2 % n1], actions_r2[k % n2])
+# where n1 and n2 are the number of actions of the two robot types, and k is
+# NO_ACTION where the policy has none, OFF_GRID for unknown states and
+# UNSOLVED for states on the grid that the policy was not solved for (see
+# sbg.export_policy)
+# a request with n = 0 asks for the counters, the reply is their length
+# (uint32) and the counters as json
+MAGIC = b"SBGQ"
+NO_ACTION = sbg.NO_ACTION
+OFF_GRID = -2
+UNSOLVED = sbg.UNSOLVED
+# most states in a request that are looked up one by one
+SMALL_BATCH = 16
+
+
+class PolicyServer:
+
+    def __init__(self, table, window=100000, max_batch=4096):
+        self.table = table
+        self.max_batch = max_batch
+        self.hello = json.dumps({"actions_h": sbg.to_json(table.actions_h),
+                                 "actions_r1": sbg.to_json(table.actions_r1),
+                                 "actions_r2": sbg.to_json(table.actions_r2)}).encode()
+        # latency of the recent requests in seconds, from the request being
+        # read until its reply is sent
+        self.latency = deque(maxlen=window)
+        self.requests = 0
+        self.states = 0
+        self.clients = 0
+
+    # joint action index of one flattened state, OFF_GRID for unknown states,
+    # including timesteps that are not whole numbers, and UNSOLVED as saved
+    def code(self, row):
+        try:
+            if row[0] != int(row[0]):
+                return OFF_GRID
+            return self.table.code((int(row[0]),) + tuple(row[1:]))
+        except (KeyError, IndexError, ValueError, OverflowError):
+            return OFF_GRID
+
+    # joint action indices of the rows of flat
+    # a few rows (e.g. the arm's state) are looked up one by one, which is
+    # faster than the numpy calls, and larger batches are ranked with numpy
+    # at once, see sbg.PolicyTable.ranks
+    # the requests are answered on the event loop, so --max-batch bounds how
+    # long one request holds up the others (4096 states take under 1 ms)
+    def answer(self, flat):
+        if len(flat) <= SMALL_BATCH:
+            return np.array([self.code(row) for row in flat.tolist()], dtype="<i4")
+        ranks = self.table.ranks(flat)
+        codes = np.full(len(flat), OFF_GRID, dtype="<i4")
+        inside = ranks >= 0
+        codes[inside] = self.table.table[ranks[inside]]
+        return codes
+
+    def counters(self):
+        latency = np.array(self.latency) * 1e6
+        p50, p99 = np.percentile(latency, [50, 99]) if len(latency) else (None, None)
+        return {"requests": self.requests, "states": self.states, "clients": self.clients,
+                "p50_us": None if p50 is None else float(p50), "p99_us": None if p99 is None else float(p99)}
+
+    # one client, until it closes the connection
+    async def handle(self, reader, writer):
+        self.clients += 1
+        width = self.table.width
+        try:
+            writer.write(MAGIC + struct.pack("<II", width, len(self.hello)) + self.hello)
+            await writer.drain()
+            while True:
+                n, = struct.unpack("<I", await reader.readexactly(4))
+                if n == 0:
+                    counters = json.dumps(self.counters()).encode()
+                    writer.write(struct.pack("<I", len(counters)) + counters)
+                    await writer.drain()
+                    continue
+                if n > self.max_batch:
+                    break
+                data = await reader.readexactly(8 * n * width)
+                start = time.perf_counter()
+                flat = np.frombuffer(data, dtype="<f8").reshape(n, width)
+                writer.write(self.answer(flat).tobytes())
+                await writer.drain()
+                self.latency.append(time.perf_counter() - start)
+                self.requests += 1
+                self.states += n
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+
+# blocking client for a control loop, e.g.
+# client = PolicyClient(path="/tmp/sbg.sock")
+# ah, ar1, ar2 = client.query([(0, (-1, -1, -1, -1, -1, -1), 0.5)])[0]
+class PolicyClient:
+
+    def __init__(self, path=None, port=8765):
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection(("127.0.0.1", port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.receive(len(MAGIC)) != MAGIC:
+            raise ValueError("not a policy server")
+        self.width, size = struct.unpack("<II", self.receive(8))
+        header = json.loads(self.receive(size))
+        self.actions_h = sbg.to_tuple(header["actions_h"])
+        self.actions_r1 = sbg.to_tuple(header["actions_r1"])
+        self.actions_r2 = sbg.to_tuple(header["actions_r2"])
+
+    def receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("the policy server closed the connection")
+            data += chunk
+        return bytes(data)
+
+    # joint action indices of the states, see the protocol above
+    def codes(self, states):
+        flat = np.array([sbg.flatten(s) for s in states], dtype="<f8")
+        if flat.shape[1:] != (self.width,):
+            raise ValueError("the states of this policy flatten to " + str(self.width) + " values")
+        self.sock.sendall(struct.pack("<I", len(states)) + flat.tobytes())
+        return np.frombuffer(self.receive(4 * len(states)), dtype="<i4")
+
+    # joint actions (ah, ar1, ar2) of the states, None where the policy has
+    # none, like pi of the value_iteration methods
+    # KeyError for unknown and unsolved states, like sbg.PolicyTable.lookup
+    def query(self, states):
+        n1, n2 = len(self.actions_r1), len(self.actions_r2)
+        actions = []
+        for s, k in zip(states, self.codes(states)):
+            if k == OFF_GRID or k == UNSOLVED:
+                raise KeyError(s)
+            actions.append(None if k == NO_ACTION else
+                           (self.actions_h[k // (n1 * n2)], self.actions_r1[k // n2 % n1], self.actions_r2[k % n2]))
+        return actions
+
+    def counters(self):
+        self.sock.sendall(struct.pack("<I", 0))
+        size, = struct.unpack("<I", self.receive(4))
+        return json.loads(self.receive(size))
+
+    def close(self):
+        self.sock.close()
+
+
+async def serve(args):
+    server = PolicyServer(sbg.PolicyTable(args.policy), args.window, args.max_batch)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        listener = await asyncio.start_unix_server(server.handle, path=args.socket)
+        print("[*] serving", args.policy, "on", args.socket)
+    else:
+        listener = await asyncio.start_server(server.handle, host="127.0.0.1", port=args.port)
+        print("[*] serving", args.policy, "on 127.0.0.1:" + str(args.port))
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(args):
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,1330 @@
+'''
+Shared solver code for the stochastic bayesian games.
+Each script keeps its own dynamics, rewards, and action spaces.
+The functions here solve those games with numpy arrays instead of dicts,
+and return the same policies and values as the value_iteration methods.
+The results of the sims are kept in one structured array per folder,
+see save_results, and solved policies can be saved for the robots as flat
+binary tables, see export_policy.
+'''
+
+import numpy as np
+import contextlib
+import copy
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+# the rounded values of np.linspace, as used in the augmented states
+def grid(lo, hi, n):
+    return tuple(round(v, 1) for v in np.linspace(lo, hi, n))
+
+
+# joint actions (ah, ar1, ar2) in the order value_iteration tries them
+def joint_actions(game):
+    return [(ah, ar1, ar2) for ah in game.actions_h
+            for ar1 in game.actions_r1 for ar2 in game.actions_r2]
+
+
+# index the augmented states of one timestep layer
+# every timestep has the same layout, so states are keyed without the timestep
+def layer_index(game):
+    index = {}
+    states = game.states.layer(0) if hasattr(game.states, "layer") else game.states
+    for s in states:
+        if s[0] == 0 and s[1:] not in index:
+            index[s[1:]] = len(index)
+    return index
+
+
+# successor table of one layer for dynamics that do not depend on the timestep
+# step(s, ah, ar1, ar2) returns the next state with the confused robot
+# and the next state with the capable robot
+# next1[k, i] and next2[k, i] are the layer indices reached from state i
+# when the team takes joint action k
+# index may hold keys that are not states of this game, those stay at 0
+def layer_successors(game, index, step):
+    actions = joint_actions(game)
+    next1 = np.zeros((len(actions), len(index)), dtype=int)
+    next2 = np.zeros((len(actions), len(index)), dtype=int)
+    for key in layer_index(game):
+        s, i = (0,) + key, index[key]
+        for k, (ah, ar1, ar2) in enumerate(actions):
+            s1, s2 = step(s, ah, ar1, ar2)
+            next1[k, i] = index[s1[1:]]
+            next2[k, i] = index[s2[1:]]
+    return next1, next2
+
+
+# step for games where f only depends on the state and the robot's own action
+# caches f, since every joint action repeats the same (ah, ar) pairs
+def pure_step(game):
+    cache = {}
+    def f(s, ah, ar):
+        if (s, ah, ar) not in cache:
+            cache[s, ah, ar] = game.f(s, ah, ar)
+        return cache[s, ah, ar]
+    return lambda s, ah, ar1, ar2: (f(s, ah, ar1), f(s, ah, ar2))
+
+
+# modified Harsanyi-Bellman Ad Hoc Coordination, one timestep layer at a time
+# weight[i] is the belief that the robot is capable in state i
+# reward[t][i] is the reward of state i at timestep t
+# next1 and next2 may have leading batch axes, e.g. [lr, joint action, state]
+# V[t] and A[t] are the values and best joint action indices of layer t
+# np.argmax keeps the first maximum, which matches the strict > in value_iteration
+def backward_induction(T, next1, next2, weight, reward):
+    V = [None] * T
+    A = [None] * T
+    V[T-1] = np.broadcast_to(reward[T-1], next1.shape[:-2] + reward[T-1].shape)
+    for t in range(T-2, -1, -1):
+        eV1 = (1 - weight) * np.take_along_axis(V[t+1][..., None, :], next1, axis=-1)
+        eV2 = weight * np.take_along_axis(V[t+1][..., None, :], next2, axis=-1)
+        Q = eV1 + eV2
+        A[t] = np.argmax(Q, axis=-2)
+        V[t] = reward[t] + np.max(Q, axis=-2)
+    return V, A
+
+
+# robot actions of both types, in order and without repeats
+# the columns of a successor table
+def robot_actions(game):
+    actions = []
+    for a in list(game.actions_r1) + list(game.actions_r2):
+        if a not in actions:
+            actions.append(a)
+    return actions
+
+
+# dense successor table for games where f only depends on the state and the
+# robot's own action, over the ranks of a StateSpace
+# table[i, h, r] is the rank of f(s, actions_h[h], robot_actions[r]) for the
+# state s with rank i, the last layer has no successors and holds -1
+# with time_invariant only the first layer calls f, the other layers have the
+# same layout and are the first layer shifted by their offsets
+def compile_successors(game, time_invariant=False):
+    states = game.states
+    actions_h = list(game.actions_h)
+    actions_r = robot_actions(game)
+    last = len(states.layers) - 1
+    table = np.full((len(states), len(actions_h), len(actions_r)), -1, dtype=np.int32)
+    for t in range(last):
+        if time_invariant and t > 0:
+            first = table[states.offsets[0]:states.offsets[1]]
+            shift = states.offsets[t+1] - states.offsets[1]
+            table[states.offsets[t]:states.offsets[t+1]] = np.where(first >= 0, first + shift, -1)
+            continue
+        for s in states.layer(t):
+            i = states.index(s)
+            for h, ah in enumerate(actions_h):
+                for r, ar in enumerate(actions_r):
+                    table[i, h, r] = states.index(game.f(s, ah, ar))
+    return table
+
+
+# successor tables are saved here and memory-mapped on later runs
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+
+# hash of everything a successor table depends on: the horizon, learning rate,
+# state axes, action sets and the source of the dynamics
+def table_key(game, time_invariant=False):
+    layers = [tuple(axis.__qualname__ if callable(axis) else axis for axis in axes)
+              for axes in game.states.layers]
+    params = (type(game).__name__, game.T, getattr(game, "lr", None), layers,
+              list(game.actions_h), robot_actions(game), time_invariant,
+              inspect.getsource(type(game).f))
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+
+# successor table of a game, compiled on the first call and then loaded from
+# the cache as a read-only memory map
+# the file is written under a temporary name first, so parallel sweep
+# workers never read a partial table
+def successor_table(game, time_invariant=False, cache=CACHE):
+    path = os.path.join(cache, type(game).__name__ + "-" + table_key(game, time_invariant) + ".npy")
+    if not os.path.exists(path):
+        table = compile_successors(game, time_invariant)
+        os.makedirs(cache, exist_ok=True)
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "wb") as file:
+            np.save(file, table)
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode="r")
+
+
+# modified Harsanyi-Bellman Ad Hoc Coordination on a successor table
+# every timestep layer is a slice of ranks, so each backup is array indexing
+# belief is the position of the belief in the augmented state
+# returns pi and V as dicts over game.states, the same as value_iteration
+def value_iteration_table(game, table, belief):
+    states = game.states
+    actions_r = robot_actions(game)
+    r1 = [actions_r.index(a) for a in game.actions_r1]
+    r2 = [actions_r.index(a) for a in game.actions_r2]
+    weight = np.zeros(len(states))
+    reward = np.zeros(len(states))
+    for s in states:
+        i = states.index(s)
+        weight[i] = belief_value(game, s[1:], belief)
+        reward[i] = game.reward(s)
+    V = np.zeros(len(states))
+    A = np.zeros(len(states), dtype=int)
+    last = len(states.layers) - 1
+    V[states.offsets[last]:] = reward[states.offsets[last]:]
+    for t in range(last-1, -1, -1):
+        rows = slice(states.offsets[t], states.offsets[t+1])
+        successors = np.asarray(table[rows])
+        w = weight[rows, None, None, None]
+        eV1 = (1 - w) * V[successors[:, :, r1]][:, :, :, None]
+        eV2 = w * V[successors[:, :, r2]][:, :, None, :]
+        Q = (eV1 + eV2).reshape(len(successors), -1)
+        A[rows] = np.argmax(Q, axis=1)
+        V[rows] = reward[rows] + np.max(Q, axis=1)
+    actions = joint_actions(game)
+    values = V.tolist()
+    best = A.tolist()
+    pi = {}
+    V1 = {}
+    for s in states:
+        i = states.index(s)
+        V1[s] = values[i]
+        pi[s] = None if s[0] == last else list(actions[best[i]])
+    return pi, V1
+
+
+# belief that the robot is capable, stored at position belief of the state
+# a LatticeGame stores a grid index there, so look up its float value
+def belief_value(game, key, belief):
+    if isinstance(game, LatticeGame):
+        return game.game.lattice[belief-1].values[key[belief-1]]
+    return key[belief-1]
+
+
+# vectorized value_iteration for games whose dynamics do not depend on t
+# belief is the position of the belief in the augmented state
+# returns pi and V as dicts over game.states, the same as value_iteration
+def value_iteration_vectorized(game, step, belief):
+    index = layer_index(game)
+    keys = list(index)
+    next1, next2 = layer_successors(game, index, step)
+    weight = np.array([belief_value(game, key, belief) for key in keys], dtype=float)
+    reward = [np.array([game.reward((t,) + key) for key in keys], dtype=float)
+              for t in range(game.T)]
+    V, A = backward_induction(game.T, next1, next2, weight, reward)
+    return to_dicts(game, index, V, A)
+
+
+# value_iteration_vectorized for copies of a game that differ only in their
+# belief dynamics, such as the learning rate
+# the copies share one state index and the reward tables, and are backed up
+# together along an extra array axis
+# returns a list with the pi and V dicts of each copy
+def value_iteration_batch(games, steps, belief):
+    index = {}
+    for game in games:
+        for key in layer_index(game):
+            index.setdefault(key, len(index))
+    keys = list(index)
+    tables = [layer_successors(game, index, step) for game, step in zip(games, steps)]
+    next1 = np.stack([table[0] for table in tables])
+    next2 = np.stack([table[1] for table in tables])
+    weight = np.array([belief_value(games[0], key, belief) for key in keys], dtype=float)
+    reward = [np.array([games[0].reward((t,) + key) for key in keys], dtype=float)
+              for t in range(games[0].T)]
+    V, A = backward_induction(games[0].T, next1, next2, weight, reward)
+    solutions = []
+    for idx, game in enumerate(games):
+        Vg = [v[idx] for v in V]
+        Ag = [None if a is None else a[idx] for a in A]
+        solutions.append(to_dicts(game, index, Vg, Ag))
+    return solutions
+
+
+# the augmented states that the game reaches from init_states (all at
+# timestep 0), yielded as one list per timestep layer up to layer last
+# every human action is tried with the actions of both robot types
+# each layer is built from the one before only, so a caller that drops the
+# layers it is done with holds at most two of them
+def reachable(game, init_states, last):
+    layer = list(dict.fromkeys(init_states))
+    yield layer
+    actions_r = robot_actions(game)
+    for t in range(last):
+        successors = {}
+        for s in layer:
+            for ah in game.actions_h:
+                for ar in actions_r:
+                    successors.setdefault(game.f(s, ah, ar), None)
+        layer = list(successors)
+        yield layer
+
+
+# the layer of reachable at timestep t, streamed again from init_states
+def reachable_layer(game, init_states, t):
+    for layer in reachable(game, init_states, t):
+        pass
+    return layer
+
+
+# the backward pass of value_iteration over the states reachable from
+# init_states only, for games whose dynamics depend on the timestep, such as
+# the tower of userstudy2
+# layer last is terminal, its states are only worth their reward
+# bonus[k] is added to the value of the confused robot for joint action k,
+# as in the trans variant of value_iteration
+# yields (states, actions, values) for each layer from last down to 0, with
+# the joint action [ah, ar1, ar2] of each state (None in layer last) and its
+# value, the same as value_iteration on those states
+# only the values of the layer after the current one are kept, and each layer
+# is streamed again from init_states (see reachable), so at most two layers
+# are held at a time, and a caller can write the policy out as it comes, see
+# export_policy
+# when the layers grow with t, such as the towers, streaming them again costs
+# about as much as the backward pass itself, otherwise layers can hold all the
+# layers of reachable, which are then used instead
+def solve_reachable(game, init_states, last, belief, bonus=None, layers=None):
+    if layers is None:
+        layer = lambda t: reachable_layer(game, init_states, t)
+    else:
+        layer = lambda t: layers[t]
+    actions = joint_actions(game)
+    states = layer(last)
+    values = np.array([game.reward(s) for s in states], dtype=float)
+    yield states, [None] * len(states), values
+    for t in range(last - 1, -1, -1):
+        index = {s: i for i, s in enumerate(states)}
+        states = layer(t)
+        next1 = np.array([[index[game.f(s, ah, ar1)] for s in states] for ah, ar1, ar2 in actions], dtype=int)
+        next2 = np.array([[index[game.f(s, ah, ar2)] for s in states] for ah, ar1, ar2 in actions], dtype=int)
+        del index
+        weight = np.array([s[belief] for s in states], dtype=float)
+        eV1 = (1 - weight) * values[next1]
+        if bonus is not None:
+            eV1 = eV1 + np.asarray(bonus, dtype=float)[:, None]
+        Q = eV1 + weight * values[next2]
+        # np.argmax keeps the first maximum, like the strict > of value_iteration
+        best = np.argmax(Q, axis=0)
+        values = np.array([game.reward(s) for s in states], dtype=float) + Q[best, np.arange(len(states))]
+        yield states, [list(actions[k]) for k in best], values
+
+
+# solve_reachable with pi and V as dicts over the reachable states
+# they hold every reachable state, so this is for games whose reachable
+# states fit in memory, such as the summaries of SummaryGame
+def value_iteration_reachable(game, init_states, last, belief, bonus=None):
+    pi, V = {}, {}
+    layers = list(reachable(game, init_states, last))
+    for states, actions, values in solve_reachable(game, init_states, last, belief, bonus, layers):
+        for s, a, v in zip(states, actions, values):
+            pi[s], V[s] = a, v
+    return pi, V
+
+
+# a game on a sufficient statistic of the states of another game
+# summarize(s) maps a state of game to its summary, step(c, ah, ar) is the
+# dynamics of the summaries and value(c) their reward
+# when the reward of a game adds up over the rounds, e.g. the tower of
+# userstudy2, the summary (timestep, accumulated reward, belief) is enough,
+# and the number of summaries grows with the number of distinct rewards
+# instead of exponentially in the rounds
+# the actions and the horizon are those of game, so it solves with
+# value_iteration_reachable
+class SummaryGame:
+
+    def __init__(self, game, summarize, step, value):
+        self.game = game
+        self.T = game.T
+        self.actions_h = game.actions_h
+        self.actions_r1 = game.actions_r1
+        self.actions_r2 = game.actions_r2
+        self.summarize = summarize
+        self.f = step
+        self.reward = value
+
+    # raises ValueError unless the summary is sufficient on the given states
+    # and their successors, which means that summarize commutes with the
+    # dynamics of every action and keeps the reward, then pi and V of game are
+    # those of the summaries
+    def check(self, states):
+        for s in states:
+            c = self.summarize(s)
+            if self.reward(c) != self.game.reward(s):
+                raise ValueError("summary " + str(c) + " changes the reward of " + str(s))
+            for ah in self.actions_h:
+                for ar in robot_actions(self):
+                    s1, c1 = self.game.f(s, ah, ar), self.f(c, ah, ar)
+                    if self.summarize(s1) != c1 or self.reward(c1) != self.game.reward(s1):
+                        raise ValueError("summary " + str(c) + " does not follow " + str(s)
+                                         + " under " + str((ah, ar)))
+
+    # policy of game from the policy of the summaries
+    def policy(self, pi, s):
+        return pi[self.summarize(s)]
+
+
+# clipped index shift by step points along one axis of a grid layer
+# shaped like np.ix_, so it broadcasts against the other axes
+def shift_axis(shape, axis, step):
+    index = np.clip(np.arange(shape[axis]) + step, 0, shape[axis] - 1)
+    return index.reshape([-1 if a == axis else 1 for a in range(len(shape))])
+
+
+# successor table of one layer for games on a grid, without calling f
+# game.grid_move(ah, ar1, ar2) returns the grid indices of the next state for
+# the confused and the capable robot, as arrays that broadcast over the layer
+def grid_successors(game, shape):
+    actions = joint_actions(game)
+    next1 = np.zeros((len(actions), int(np.prod(shape))), dtype=int)
+    next2 = np.zeros((len(actions), int(np.prod(shape))), dtype=int)
+    for k, (ah, ar1, ar2) in enumerate(actions):
+        move1, move2 = game.grid_move(ah, ar1, ar2)
+        next1[k] = np.ravel_multi_index([np.broadcast_to(i, shape) for i in move1], shape).ravel()
+        next2[k] = np.ravel_multi_index([np.broadcast_to(i, shape) for i in move2], shape).ravel()
+    return next1, next2
+
+
+# value_iteration_batch for games whose states are a grid, like the 2D robot arm
+# every layer is the StateSpace grid of the first one, so successors are index
+# shifts of the whole grid (see grid_successors) and a backup is a few array ops
+# the layer is indexed by StateSpace rank, repeated values of a callable axis
+# keep their slot and are looked up at the first one, like StateSpace.index
+# the games share the grid but not the values on it (the new beliefs of the
+# memory models depend on the learning rate), so each has its own weights
+# the rewards only depend on the timestep and position, so they are shared
+# returns a list with the pi and V dicts of each game
+def value_iteration_grid(games, belief):
+    shape = tuple(games[0].states.sizes[0])
+    layers = [[s[1:] for s in game.states.layer(0)] for game in games]
+    tables = [grid_successors(game, shape) for game in games]
+    next1 = np.stack([table[0] for table in tables])
+    next2 = np.stack([table[1] for table in tables])
+    weight = np.array([[belief_value(game, key, belief) for key in keys]
+                       for game, keys in zip(games, layers)], dtype=float)[:, None, :]
+    reward = [np.array([games[0].reward((t,) + key) for key in layers[0]], dtype=float)
+              for t in range(games[0].T)]
+    V, A = backward_induction(games[0].T, next1, next2, weight, reward)
+    solutions = []
+    for idx, (game, keys) in enumerate(zip(games, layers)):
+        index = {}
+        for i, key in enumerate(keys):
+            index.setdefault(key, i)
+        Vg = [v[idx] for v in V]
+        Ag = [None if a is None else a[idx] for a in A]
+        solutions.append(to_dicts(game, index, Vg, Ag))
+    return solutions
+
+
+# convert layer arrays back to the pi and V dicts used by the scripts
+# pi is None at the last timestep, like in value_iteration
+def to_dicts(game, index, V, A):
+    actions = joint_actions(game)
+    values = [v.tolist() for v in V]
+    best = [None if a is None else a.tolist() for a in A]
+    pi = {}
+    V1 = {}
+    for s in game.states:
+        t, i = s[0], index[s[1:]]
+        V1[s] = values[t][i]
+        pi[s] = None if best[t] is None else list(actions[best[t][i]])
+    return pi, V1
+
+
+# the sims only reward the last timestep and f does not depend on t,
+# so timestep t of a T horizon game is timestep t+k of a T+k horizon game
+# re-keys a pi or V table solved at horizon T+k for the horizon T game
+def shift_horizon(table, k):
+    return {(s[0]-k,) + s[1:]: v for s, v in table.items() if s[0] >= k}
+
+
+# evenly spaced grid of floats, stored as integer indices
+# index i stands for lo + i * step, rounded like the states in the scripts
+class Lattice:
+
+    def __init__(self, lo, hi, step):
+        self.lo = lo
+        self.step = step
+        self.n = int(round((hi - lo) / step)) + 1
+        self.values = [round(lo + i * step, 10) for i in range(self.n)]
+
+    # grid index of a float value
+    def index(self, value):
+        i = int(round((value - self.lo) / self.step))
+        if i < 0 or i >= self.n or abs(self.values[i] - value) > 1e-6:
+            raise ValueError(str(value) + " is not on the lattice")
+        return i
+
+    # whether a float increment is a whole number of grid steps
+    def is_step(self, delta):
+        return abs(round(delta / self.step) * self.step - delta) <= 1e-6
+
+    # number of grid steps in a float increment, like an action or learning rate
+    def steps(self, delta):
+        if not self.is_step(delta):
+            raise ValueError(str(delta) + " is not a multiple of the lattice step")
+        return int(round(delta / self.step))
+
+
+# integer lattice version of a game
+# game.lattice has a Lattice for every coordinate after the timestep,
+# game.action_lattice has one for every action component (or one for scalar
+# actions), and game.f_lattice is the dynamics on grid indices
+# floats only appear when states and policies are converted at the boundary
+class LatticeGame:
+
+    def __init__(self, game):
+        self.game = game
+        self.T = game.T
+        if hasattr(game, "lr"):
+            game.lattice[-1].steps(game.lr)
+        self.actions_r1 = [self.to_action(a) for a in game.actions_r1]
+        self.actions_r2 = [self.to_action(a) for a in game.actions_r2]
+        self.actions_h = [self.to_action(a) for a in game.actions_h]
+        # the float action behind every step, so actions convert back exactly
+        self.float_actions = {self.to_action(a): a for a in
+                              list(game.actions_h) + list(game.actions_r1) + list(game.actions_r2)}
+        self.states = LatticeStates(self)
+        self.f = game.f_lattice
+
+    def to_lattice(self, s):
+        return (s[0],) + tuple(axis.index(v) for axis, v in zip(self.game.lattice, s[1:]))
+
+    def from_lattice(self, s):
+        return (s[0],) + tuple(axis.values[i] for axis, i in zip(self.game.lattice, s[1:]))
+
+    def to_action(self, a):
+        if isinstance(a, tuple):
+            return tuple(axis.steps(x) for axis, x in zip(self.game.action_lattice, a))
+        return self.game.action_lattice.steps(a)
+
+    def from_action(self, a):
+        return self.float_actions[a]
+
+    # reward is only needed once per state, so it goes through the float game
+    def reward(self, s):
+        return self.game.reward(self.from_lattice(s))
+
+    # convert a float policy to grid indices and steps
+    def to_lattice_policy(self, pi):
+        return {self.to_lattice(s): None if a is None else [self.to_action(x) for x in a]
+                for s, a in pi.items()}
+
+    # convert a policy on the lattice back to floats
+    def from_lattice_policy(self, pi):
+        return {self.from_lattice(s): None if a is None else [self.from_action(x) for x in a]
+                for s, a in pi.items()}
+
+
+# implicit augmented state space, nothing is materialized
+# layers[t] lists the axes of the states at timestep t, where an axis is a
+# tuple of values, or a function of the earlier coordinates that returns a
+# tuple of fixed length (like the new belief of the memory models)
+# states are ranked in the order of the nested loops that used to build
+# self.states, so iterating gives the same list, duplicates included
+# pack(t, coords) and unpack(s) convert between states and flat coordinates
+class StateSpace:
+
+    def __init__(self, layers, pack=None, unpack=None):
+        self.layers = [tuple(axes) for axes in layers]
+        self.pack = pack or (lambda t, coords: (t,) + coords)
+        self.unpack = unpack or (lambda s: (s[0], s[1:]))
+        self.sizes = []
+        self.offsets = []
+        self.lookup = []
+        total = 0
+        for axes in self.layers:
+            sizes = []
+            prefix = ()
+            for axis in axes:
+                values = axis(prefix) if callable(axis) else axis
+                sizes.append(len(values))
+                prefix += (values[0],)
+            self.sizes.append(sizes)
+            self.offsets.append(total)
+            self.lookup.append([None if callable(axis) else {v: i for i, v in enumerate(axis)}
+                                for axis in axes])
+            total += int(np.prod(sizes))
+        self.size = total
+        # values of the callable axes for each prefix, they are asked for often
+        self.axis_values = {}
+
+    # values of axis j of layer t after the coordinates prefix
+    def values(self, t, j, prefix):
+        axis = self.layers[t][j]
+        if not callable(axis):
+            return axis
+        if (t, j, prefix) not in self.axis_values:
+            self.axis_values[t, j, prefix] = axis(prefix)
+        return self.axis_values[t, j, prefix]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for t in range(len(self.layers)):
+            yield from self.layer(t)
+
+    def __contains__(self, s):
+        try:
+            self.index(s)
+        except (KeyError, IndexError, TypeError):
+            return False
+        return True
+
+    # states with timestep t, in rank order
+    def layer(self, t):
+        axes = self.layers[t]
+        if not any(callable(axis) for axis in axes):
+            return (self.pack(t, coords) for coords in itertools.product(*axes))
+        def expand(prefix):
+            if len(prefix) == len(axes):
+                yield self.pack(t, prefix)
+                return
+            for v in self.values(t, len(prefix), prefix):
+                yield from expand(prefix + (v,))
+        return expand(())
+
+    # flat integer index of a state
+    def index(self, s):
+        t, coords = self.unpack(s)
+        if t < 0 or len(coords) != len(self.layers[t]):
+            raise KeyError(s)
+        rank = 0
+        for j, v in enumerate(coords):
+            lookup = self.lookup[t][j]
+            if lookup is None:
+                values = self.values(t, j, coords[:j])
+                if v not in values:
+                    raise KeyError(s)
+                position = values.index(v)
+            else:
+                position = lookup[v]
+            rank = rank * self.sizes[t][j] + position
+        return self.offsets[t] + rank
+
+    # state with flat integer index i
+    def state(self, i):
+        if i < 0 or i >= self.size:
+            raise IndexError(i)
+        t = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        rank = i - self.offsets[t]
+        positions = []
+        for size in reversed(self.sizes[t]):
+            rank, position = divmod(rank, size)
+            positions.append(position)
+        coords = ()
+        for j, position in enumerate(reversed(positions)):
+            coords += (self.values(t, j, coords)[position],)
+        return self.pack(t, coords)
+
+
+# the states of a LatticeGame, converted one at a time from the game's states
+# when every axis of the game's states is the values of its Lattice, the grid
+# indices are the positions on the axes, and index ranks the integer states
+# directly, otherwise (e.g. the new beliefs of the memory models) it goes
+# through the float states
+class LatticeStates:
+
+    def __init__(self, lattice_game):
+        self.lattice_game = lattice_game
+        space = lattice_game.game.states
+        lattice = lattice_game.game.lattice
+        self.direct = isinstance(space, StateSpace) and all(
+            len(axes) == len(lattice) and
+            all(not callable(axis) and list(axis) == grid.values for axis, grid in zip(axes, lattice))
+            for axes in space.layers)
+
+    def __len__(self):
+        return len(self.lattice_game.game.states)
+
+    def __iter__(self):
+        return (self.lattice_game.to_lattice(s) for s in self.lattice_game.game.states)
+
+    def layer(self, t):
+        return (self.lattice_game.to_lattice(s) for s in self.lattice_game.game.states.layer(t))
+
+    def index(self, s):
+        space = self.lattice_game.game.states
+        if not self.direct:
+            return space.index(self.lattice_game.from_lattice(s))
+        t, coords = s[0], s[1:]
+        if t < 0 or t >= len(space.layers) or len(coords) != len(space.sizes[t]):
+            raise KeyError(s)
+        rank = 0
+        for i, size in zip(coords, space.sizes[t]):
+            if i < 0 or i >= size:
+                raise KeyError(s)
+            rank = rank * size + i
+        return space.offsets[t] + rank
+
+
+# exact version of check_opaque with the random human
+# searches the pairs (s1, s2) of the confused and the capable robot's states,
+# branching over every human action in both rollouts
+# the human policy is a function of the state, and the states hold the
+# timestep, so the rollouts can only share a state at the same step, where
+# the human must take the same action in both
+# step(s, ah, robot) is the next state when the robot of type robot (1 or 2)
+# follows pi, belief(s) is the belief in state s
+# returns None if no human policy separates the final beliefs, otherwise a
+# witness human policy as a dict over the visited states
+# dead holds the pairs, with their steps left, from which no human separates
+# the beliefs; a pair's answer only depends on the pair, so the initial states
+# of one game and pi can share it, and then every pair is searched once per
+# step in all of the checks together
+def adversarial_human(init_state, actions_h, step, steps, belief, dead=None):
+    if dead is None:
+        dead = set()
+    # every state meets many partners, so its successors are only computed once
+    successors = {}
+    def next_state(s, ah, robot):
+        if (s, ah, robot) not in successors:
+            successors[s, ah, robot] = step(s, ah, robot)
+        return successors[s, ah, robot]
+    def search(s1, s2, k):
+        if k == steps:
+            return {} if abs(belief(s1) - belief(s2)) > 1e-3 else None
+        if (s1, s2, steps - k) in dead:
+            return None
+        for ah1 in actions_h:
+            for ah2 in ([ah1] if s1 == s2 else actions_h):
+                witness = search(next_state(s1, ah1, 1), next_state(s2, ah2, 2), k+1)
+                if witness is not None:
+                    witness[s1] = ah1
+                    witness[s2] = ah2
+                    return witness
+        dead.add((s1, s2, steps - k))
+        return None
+    return search(init_state, init_state, 0)
+
+
+# belief of every state, by StateSpace rank
+# ranks that no state maps to (repeated values of a callable axis) stay 0
+def state_beliefs(game, belief):
+    beliefs = np.zeros(len(game.states))
+    for s in game.states:
+        beliefs[game.states.index(s)] = belief_value(game, s[1:], belief)
+    return beliefs
+
+
+# successor rank of every state when the team follows pi, for the
+# confused and the capable robot
+# step(s, robot) is the next state with the robot of type robot (1 or 2)
+# the last layer has no successors and points at itself
+def policy_successors(states, step):
+    next1 = np.arange(len(states))
+    next2 = np.arange(len(states))
+    for t in range(len(states.layers) - 1):
+        for s in states.layer(t):
+            i = states.index(s)
+            next1[i] = states.index(step(s, 1))
+            next2[i] = states.index(step(s, 2))
+    return next1, next2
+
+
+# rank of the last state that the rollout from every state reaches
+# following a successor array, composed one layer at a time from the back:
+# a state ends where its successor ends
+def final_states(states, successors):
+    final = np.arange(len(states))
+    for t in range(len(states.layers) - 2, -1, -1):
+        rows = slice(states.offsets[t], states.offsets[t+1])
+        final[rows] = final[successors[rows]]
+    return final
+
+
+# rational opacity of every state of a solved game at once, as a mask over
+# the StateSpace ranks
+# with the rational human the rollouts of check_opaque follow next1 and
+# next2 (see policy_successors), and a state is opaque when both end in the
+# same belief; beliefs holds the belief of every rank (see state_beliefs)
+# the states of every timestep are labeled, and since the sims only reward
+# the last timestep, a state at timestep t of a T horizon game is labeled
+# as the start of a T - t horizon game
+def rational_opaque(states, next1, next2, beliefs):
+    final1 = final_states(states, next1)
+    final2 = final_states(states, next2)
+    return np.abs(beliefs[final1] - beliefs[final2]) <= 1e-3
+
+
+# number of random humans to sample for the sequential full opacity check
+# if none of n independent random humans tells the robot types apart, the
+# probability p that one does is below epsilon with the given confidence once
+# (1 - epsilon)^n <= 1 - confidence, the zero-failure binomial bound
+# the check stops earlier at the first human that tells them apart
+# fixed humans that every state meets first (the constant humans of the 1D
+# sims) are not independent draws, so they do not count toward the bound and
+# are added on top of it
+def random_samples(epsilon, confidence=0.95, fixed=0):
+    return fixed + int(np.ceil(np.log(1 - confidence) / np.log(1 - epsilon)))
+
+
+# independent random generators, one for each of n initial states
+# stream i only depends on the seed and i, so the random humans that initial
+# state i meets do not depend on the other states, the order in which they are
+# checked, or the worker that checks them
+def random_streams(seed, n):
+    return [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(n)]
+
+
+# random human policy that draws an action the first time a state is visited
+# and keeps it, so the rollouts of both robot types meet the same human
+# a rollout only visits T-1 states, so nothing is drawn for the rest
+# with a fixed action, every state gets that action
+# rng is a numpy Generator, by default actions come from numpy's global state
+class LazyPolicy:
+
+    def __init__(self, actions, action=None, rng=None):
+        self.actions = actions
+        self.action = action
+        self.rng = rng
+        self.choices = {}
+
+    def __getitem__(self, s):
+        if self.action is not None:
+            return self.action
+        if s not in self.choices:
+            if self.rng is None:
+                self.choices[s] = self.actions[np.random.randint(len(self.actions))]
+            else:
+                self.choices[s] = self.actions[self.rng.integers(len(self.actions))]
+        return self.choices[s]
+
+
+# the game of the bayes models with the joint action of pi filled in
+# their f(s, ah, ar, a) compares the robot's action ar with the actions a[1]
+# and a[2] of both types, so with a = pi[s] the successors only depend on the
+# state and the actions, as compile_successors needs
+# the table depends on pi, so it is compiled for each policy and not cached
+class PolicyGame:
+
+    def __init__(self, game, pi):
+        self.game = game
+        self.pi = pi
+        self.T = game.T
+        self.states = game.states
+        self.actions_h = game.actions_h
+        self.actions_r1 = game.actions_r1
+        self.actions_r2 = game.actions_r2
+
+    def f(self, s, ah, ar):
+        return self.game.f(s, ah, ar, self.pi[s])
+
+    def table_game(self, belief):
+        return TableGame(self.game, self.pi, belief, table=compile_successors(self))
+
+
+# rollouts of a solved game on its successor table
+# pi is stored as action indices per rank, so a rollout step is one lookup
+# with a horizon T shorter than the game's, the states are read as states of
+# the T horizon game, i.e. timestep t is timestep t + game.T - T of the table
+class TableGame:
+
+    def __init__(self, game, pi, belief, T=None, time_invariant=False, table=None):
+        self.game = game
+        self.T = game.T if T is None else T
+        self.shift = game.T - self.T
+        self.actions_h = list(game.actions_h)
+        # a plain array view of the memory map, which indexes faster
+        # table, if given, is a successor table compiled by the caller
+        self.table = np.asarray(successor_table(game, time_invariant) if table is None else table)
+        states = game.states
+        actions_r = robot_actions(game)
+        self.human = np.zeros(len(states), dtype=int)
+        self.robot1 = np.zeros(len(states), dtype=int)
+        self.robot2 = np.zeros(len(states), dtype=int)
+        self.belief = np.zeros(len(states))
+        self.timestep = np.zeros(len(states), dtype=int)
+        for s in states:
+            i = states.index(s)
+            self.belief[i] = belief_value(game, s[1:], belief)
+            self.timestep[i] = s[0]
+            if pi[s] is not None:
+                ah, ar1, ar2 = pi[s]
+                self.human[i] = self.actions_h.index(ah)
+                self.robot1[i] = actions_r.index(ar1)
+                self.robot2[i] = actions_r.index(ar2)
+        self.last = len(states.layers) - 1
+
+    # the same table, read as a T horizon game
+    def horizon(self, T):
+        table_game = copy.copy(self)
+        table_game.T = T
+        table_game.shift = self.game.T - T
+        return table_game
+
+    # rank of a state of the T horizon game
+    def index(self, s):
+        return self.game.states.index((s[0] + self.shift,) + s[1:])
+
+    # rational opacity of every state of the table, see rational_opaque
+    # the successors under pi are gathered from the table in one step
+    def rational_opaque(self):
+        ranks = np.arange(len(self.belief))
+        last = self.timestep == self.last
+        next1 = np.where(last, ranks, self.table[ranks, self.human, self.robot1])
+        next2 = np.where(last, ranks, self.table[ranks, self.human, self.robot2])
+        return rational_opaque(self.game.states, next1, next2, self.belief)
+
+    # rank of the last state when the robot of type robot (1 or 2) follows pi
+    # human maps ranks to action indices, otherwise the human follows pi
+    def rollout(self, i, robot, human=None):
+        robot = self.robot1 if robot == 1 else self.robot2
+        human = self.human if human is None else human
+        for t in range(self.last - self.timestep[i]):
+            i = self.table[i, human[i], robot[i]]
+        return i
+
+    # final beliefs of the rollouts from each of the states with ranks starts,
+    # one random human per row, advancing both robot types in lockstep
+    # draws[i, n, k] holds the two human actions (indices) of row n of start i
+    # for its k-th step, the first for robot type 1 and the second for type 2,
+    # which only takes its own action when the rollouts are in different states,
+    # since a human policy is a function of the state
+    # rows below len(fixed) take the action fixed[row] everywhere
+    # returns two [len(starts), N] arrays
+    def rollouts(self, starts, draws, fixed=()):
+        starts = np.asarray(starts)
+        N = draws.shape[1]
+        draws = draws.reshape(len(starts) * N, -1, 2)
+        constant = np.array([self.actions_h.index(a) for a in fixed[:N]], dtype=int)
+        fixed_rows = np.tile(np.arange(N) < len(constant), len(starts))
+        fixed_actions = np.tile(np.resize(constant, N), len(starts))
+        s1 = np.repeat(starts, N)
+        s2 = np.repeat(starts, N)
+        for k in range(draws.shape[1]):
+            h1 = draws[:, k, 0]
+            h2 = np.where(s1 == s2, h1, draws[:, k, 1])
+            h1 = np.where(fixed_rows, fixed_actions, h1)
+            h2 = np.where(fixed_rows, fixed_actions, h2)
+            # rollouts that started later are already at the last timestep
+            moving = self.timestep[s1] < self.last
+            s1 = np.where(moving, self.table[s1, h1, self.robot1[s1]], s1)
+            s2 = np.where(moving, self.table[s2, h2, self.robot2[s2]], s2)
+        shape = (len(starts), N)
+        return self.belief[s1].reshape(shape), self.belief[s2].reshape(shape)
+
+    # full opacity of the states with ranks starts, against the rational,
+    # random or adversarial humans of check_opaque
+    # the N random humans are rolled out in chunks of doubling size (see
+    # rollouts), and a state that is shown not to be opaque drops out of the
+    # next chunks
+    # rngs holds one numpy Generator per state (see random_streams), the
+    # chunks of a state are drawn from its own generator, so its label does not
+    # depend on the other states of the batch
+    # without rngs, the streams are seeded from numpy's global state, so
+    # np.random.seed still repeats a run
+    # returns the labels and the number of random humans rolled out for each
+    # state, which is N for the opaque states (see random_samples)
+    def opaque(self, starts, human_type="rational", N=1000, fixed=(), rngs=None):
+        starts = np.asarray(starts, dtype=int)
+        if human_type == "adversarial":
+            dead = set()
+            labels = [self.adversarial_opaque(i, dead) for i in starts]
+            return np.array(labels, dtype=bool), np.zeros(len(starts), dtype=int)
+        if human_type != "random":
+            final1 = np.array([self.rollout(i, 1) for i in starts], dtype=int)
+            final2 = np.array([self.rollout(i, 2) for i in starts], dtype=int)
+            return np.abs(self.belief[final1] - self.belief[final2]) <= 1e-3, np.ones(len(starts), dtype=int)
+        if rngs is None:
+            rngs = random_streams(np.random.randint(2**31), len(starts))
+        steps = self.last - self.timestep[starts]
+        opaque = np.ones(len(starts), dtype=bool)
+        samples = np.full(len(starts), N, dtype=int)
+        done, size = 0, 8
+        while done < N and opaque.any():
+            live = np.flatnonzero(opaque)
+            n = min(size, N - done)
+            draws = np.zeros((len(live), n, steps[live].max(), 2), dtype=int)
+            for j, i in enumerate(live):
+                draws[j, :, :steps[i]] = rngs[i].integers(len(self.actions_h), size=(n, steps[i], 2))
+            belief1, belief2 = self.rollouts(starts[live], draws, fixed[done:])
+            separated = np.abs(belief1 - belief2) > 1e-3
+            opaque[live] = ~separated.any(axis=1)
+            # the first human that tells the robot types apart ends the check
+            samples[live] = np.where(opaque[live], N, done + separated.argmax(axis=1) + 1)
+            done += n
+            size *= 2
+        return opaque, samples
+
+    # full opacity of the state with rank i against every human policy,
+    # see adversarial_human, the checks of one table can share dead
+    def adversarial_opaque(self, i, dead=None):
+        def step(j, h, robot):
+            return int(self.table[j, h, (self.robot1 if robot == 1 else self.robot2)[j]])
+        return adversarial_human(i, range(len(self.actions_h)), step, self.last - self.timestep[i],
+                                 lambda j: self.belief[j], dead) is None
+
+    # check_opaque of the sim scripts, with the same rational, random and
+    # adversarial humans
+    # the random humans first take each action in fixed everywhere (the
+    # adversarial humans of sim_1d), then a random action per state, see opaque
+    def check_opaque(self, init_state, human_type="rational", N=1000, fixed=(), rng=None):
+        labels, samples = self.opaque([self.index(init_state)], human_type, N, fixed, None if rng is None else [rng])
+        return bool(labels[0])
+
+
+# arrays of a TableGame that the workers of parallel_opaque map from shared
+# memory, and the table of each worker
+SHARED_ARRAYS = ("table", "human", "robot1", "robot2", "belief", "timestep")
+WORKER_TABLE = None
+
+
+# copies the arrays of table_game into blocks of shared memory
+# returns the blocks, which the caller closes and unlinks, and the name,
+# shape and dtype of each array for attach_table
+def share_table(table_game):
+    blocks, specs = [], {}
+    for name in SHARED_ARRAYS:
+        array = np.ascontiguousarray(getattr(table_game, name))
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+# worker initializer of parallel_opaque, maps the shared arrays into a
+# TableGame without its game, which works on ranks only
+def attach_table(specs, actions_h, last):
+    global WORKER_TABLE
+    table_game = TableGame.__new__(TableGame)
+    table_game.blocks = []
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        table_game.blocks.append(block)
+        setattr(table_game, name, np.ndarray(shape, dtype, buffer=block.buf))
+    table_game.actions_h = actions_h
+    table_game.last = last
+    WORKER_TABLE = table_game
+
+
+def worker_opaque(starts, human_type, N, fixed, rngs):
+    return WORKER_TABLE.opaque(starts, human_type, N, fixed, rngs)
+
+
+# full opacity of many initial states, with the states sharded over worker
+# processes, see TableGame.opaque
+# the workers read the successor table and the policy from shared memory
+# instead of unpickling them, and only get the ranks and streams of a shard
+# the random humans of a state come from its own stream in rngs, so the
+# labels do not depend on the number of workers
+def parallel_opaque(table_game, init_states, human_type, N=1000, fixed=(), rngs=None, workers=1):
+    starts = np.array([table_game.index(s) for s in init_states], dtype=int)
+    if rngs is None and human_type == "random":
+        rngs = random_streams(np.random.randint(2**31), len(starts))
+    if workers <= 1 or len(starts) < 2:
+        return table_game.opaque(starts, human_type, N, fixed, rngs)
+    # a few shards per worker, since the adversarial search takes longer on
+    # some states than on others
+    shards = [shard for shard in np.array_split(np.arange(len(starts)), 4 * workers) if len(shard)]
+    blocks, specs = share_table(table_game)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_table,
+                                 initargs=(specs, table_game.actions_h, table_game.last)) as pool:
+            futures = [pool.submit(worker_opaque, starts[shard], human_type, N, fixed,
+                                   None if rngs is None else [rngs[i] for i in shard])
+                       for shard in shards]
+            results = [future.result() for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+# every sim run adds one row per initial state to the results.npy of its
+# folder (e.g., sim1/results.npy), a structured array with the parameters of
+# the run (model, T and lr, which is nan for bayes), the augmented initial
+# state (padded with nan, the folders mix state sizes), whether the state is
+# rationally and fully opaque, and how many random humans the full check
+# rolled out (0 for the other humans)
+# np.load(path, mmap_mode='r') maps it without unpickling anything, and the
+# fields filter like columns, e.g. data[(data['model'] == 'basic') & (data['T'] == 10)]
+RESULTS = "results.npy"
+
+
+def results_dtype(width):
+    return np.dtype([("model", "U8"), ("T", "i4"), ("lr", "f8"), ("state", "f8", (width,)),
+                     ("rational", "?"), ("full", "?"), ("samples", "i4")])
+
+
+# rows of runs with learning rate lr, None for bayes
+def lr_rows(data, lr):
+    return np.isnan(data["lr"]) if lr is None else np.isclose(data["lr"], lr)
+
+
+# the rows of data with states padded to width
+def widen(data, width):
+    rows = np.zeros(len(data), dtype=results_dtype(width))
+    for name in data.dtype.names:
+        if name != "state":
+            rows[name] = data[name]
+    rows["state"] = np.nan
+    rows["state"][:, :data["state"].shape[1]] = data["state"]
+    return rows
+
+
+# the results of a folder, optionally only those of one model, T and lr
+# the whole store is memory mapped, only the selected rows are read
+def load_results(folder, model=None, T=None, lr=False):
+    path = os.path.join(folder, RESULTS)
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=results_dtype(1))
+    data = np.load(path, mmap_mode="r")
+    rows = np.ones(len(data), dtype=bool)
+    if model is not None:
+        rows &= data["model"] == model
+    if T is not None:
+        rows &= data["T"] == T
+    if lr is not False:
+        rows &= lr_rows(data, lr)
+    return data[rows]
+
+
+def has_results(folder, model, T, lr):
+    return len(load_results(folder, model, T, lr)) > 0
+
+
+# exclusive lock on folder, flock where there is one, otherwise (e.g. on
+# windows) a lock file that only one process can create
+@contextlib.contextmanager
+def folder_lock(folder):
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    if fcntl is not None:
+        lock = os.open(folder, os.O_RDONLY)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock)
+        return
+    path = os.path.join(folder, RESULTS + ".lock")
+    while True:
+        try:
+            lock = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(lock)
+        os.remove(path)
+
+
+# replaces the rows of the run (model, T, lr) in the store of folder with
+# the opaque_states of the sim script, samples maps the same keys to the
+# number of random humans
+# the folder is locked while the store is rewritten, since the runs of
+# sweep.py save in parallel, and the rows are sorted so the file does not
+# depend on the order in which the runs finish
+def save_results(folder, model, T, lr, opaque_states, samples=None):
+    samples = samples or {}
+    states = [opaque_states[key][0] for key in opaque_states]
+    rows = np.zeros(len(states), dtype=results_dtype(max(len(s) for s in states)))
+    rows["model"] = model
+    rows["T"] = T
+    rows["lr"] = np.nan if lr is None else lr
+    rows["state"] = states
+    rows["rational"] = [bool(opaque_states[key][1]) for key in opaque_states]
+    rows["full"] = [bool(opaque_states[key][2]) for key in opaque_states]
+    rows["samples"] = [samples.get(key, 0) for key in opaque_states]
+    path = os.path.join(folder, RESULTS)
+    with folder_lock(folder):
+        if os.path.exists(path):
+            data = np.load(path)
+            data = data[~((data["model"] == model) & (data["T"] == T) & lr_rows(data, lr))]
+            width = max(data["state"].shape[1], rows["state"].shape[1])
+            rows = np.concatenate([widen(data, width), widen(rows, width)])
+        rows = rows[np.argsort(rows, order=["model", "T", "lr"], kind="stable")]
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, rows)
+        os.replace(tmp, path)
+    return path
+
+
+# policy files
+# a policy over a StateSpace is saved as the grid axes and the action sets in
+# a small json header, and one joint action index per rank of the state
+# space, NO_ACTION where the policy has no action (e.g. terminal states) and
+# UNSOLVED for the states that pi does not hold (e.g. the towers that the
+# reachable solver never reaches)
+# PolicyTable maps the file and looks states up by their rank, so the robot
+# does not unpickle a dict of every state, or import the script that solved it
+# the states are flattened, e.g. (t, (blocks...), b) -> (t, blocks..., b), and
+# the header lists which flat positions hold the coordinates of each layer,
+# the others must hold the pad value (the empty slots of the tower)
+POLICY_MAGIC = b"SBGPOL1\n"
+NO_ACTION = -1
+UNSOLVED = -3
+
+
+def to_json(value):
+    return [to_json(v) for v in value] if isinstance(value, (tuple, list, range)) else value
+
+
+def to_tuple(value):
+    return tuple(to_tuple(v) for v in value) if isinstance(value, list) else value
+
+
+def flatten(s):
+    flat = []
+    for v in s:
+        if isinstance(v, tuple):
+            flat.extend(v)
+        else:
+            flat.append(v)
+    return flat
+
+
+# writes the policy pi (a dict from states to [ah, ar1, ar2]) of game to path
+# pi can also be an iterable of (state, action) pairs, which are written as
+# they come, e.g. the layers of solve_reachable
+# pad is the value of the empty coordinates of a state, if any
+def export_policy(game, pi, path, pad=None):
+    space = game.states
+    if any(callable(axis) for axes in space.layers for axis in axes):
+        raise ValueError("the axes of the state space must be fixed to export a policy")
+    if pad is not None and any(pad in axis for axes in space.layers for axis in axes):
+        raise ValueError("pad " + str(pad) + " is a value of the state space")
+    # flat positions after the timestep that hold the coordinates and the
+    # pads of each layer
+    slots, pads = [], []
+    for t in range(len(space.layers)):
+        flat = flatten(space.state(space.offsets[t]))[1:]
+        slots.append([j for j, v in enumerate(flat) if pad is None or v != pad])
+        pads.append([j for j, v in enumerate(flat) if pad is not None and v == pad])
+    actions = joint_actions(game)
+    codes = {a: k for k, a in enumerate(actions)}
+    dtype = np.int8 if len(actions) < 128 else np.int16 if len(actions) < 2**15 else np.int32
+    table = np.full(len(space), UNSOLVED, dtype=dtype)
+    header = json.dumps({"layers": to_json(space.layers), "actions_h": to_json(game.actions_h),
+                         "actions_r1": to_json(game.actions_r1), "actions_r2": to_json(game.actions_r2),
+                         "pad": pad, "slots": slots, "pads": pads, "dtype": table.dtype.str}).encode()
+    # the table starts on a multiple of 8 bytes
+    header += b" " * (-(len(POLICY_MAGIC) + 4 + len(header)) % 8)
+    tmp = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(POLICY_MAGIC + len(header).to_bytes(4, "little") + header)
+        start = f.tell()
+        f.write(table.tobytes())
+    # the file must rank every state of pi like the state space
+    saved = PolicyTable(tmp)
+    for s, a in (pi.items() if isinstance(pi, dict) else pi):
+        k = space.index(s)
+        if saved.index(s) != k:
+            del saved
+            os.remove(tmp)
+            raise ValueError("state " + str(s) + " does not flatten to its coordinates")
+        table[k] = NO_ACTION if a is None else codes[tuple(a)]
+    del saved
+    with open(tmp, "r+b") as f:
+        f.seek(start)
+        f.write(table.tobytes())
+    os.replace(tmp, path)
+    return path
+
+
+class PolicyTable:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(POLICY_MAGIC)) != POLICY_MAGIC:
+                raise ValueError(path + " is not a policy file")
+            size = int.from_bytes(f.read(4), "little")
+            header = json.loads(f.read(size))
+        self.actions_h = to_tuple(header["actions_h"])
+        self.actions_r1 = to_tuple(header["actions_r1"])
+        self.actions_r2 = to_tuple(header["actions_r2"])
+        self.pad = header["pad"]
+        # flat positions of the coordinates of each layer, and of its pads
+        self.slots = header["slots"]
+        self.pads = header["pads"]
+        # length of the flattened states, with the pad values
+        self.width = 1 + max(len(slots) + len(pads) for slots, pads in zip(self.slots, self.pads))
+        # position of each value on each axis, and the offset and the
+        # mixed radix strides of each layer
+        # ranks also keeps the sorted values of each axis with their positions
+        self.positions, self.offsets, self.strides, self.sorted_axes = [], [], [], []
+        total = 0
+        for axes in header["layers"]:
+            self.positions.append([{to_tuple(v): i for i, v in enumerate(axis)} for axis in axes])
+            orders = [np.argsort(np.array(axis, dtype=float), kind="stable") for axis in axes]
+            self.sorted_axes.append([(np.array(axis, dtype=float)[order], order) for axis, order in zip(axes, orders)])
+            strides = [1] * len(axes)
+            for j in range(len(axes) - 2, -1, -1):
+                strides[j] = strides[j+1] * len(axes[j+1])
+            self.offsets.append(total)
+            self.strides.append(strides)
+            total += strides[0] * len(axes[0]) if axes else 1
+        self.table = np.memmap(path, dtype=np.dtype(header["dtype"]), mode="r",
+                               offset=len(POLICY_MAGIC) + 4 + size, shape=(total,))
+
+    # flat index of a state, KeyError if it is not on the grid
+    def index(self, s):
+        flat = flatten(s)
+        t = flat[0]
+        if t < 0 or t >= len(self.positions) or len(flat) != len(self.slots[t]) + len(self.pads[t]) + 1:
+            raise KeyError(s)
+        if any(flat[1 + j] != self.pad for j in self.pads[t]):
+            raise KeyError(s)
+        coords = [flat[1 + j] for j in self.slots[t]]
+        rank = self.offsets[t]
+        for v, positions, stride in zip(coords, self.positions[t], self.strides[t]):
+            rank += positions[v] * stride
+        return rank
+
+    # flat indices of the rows of flat, an array of flattened states, at once
+    # -1 for the rows that are not on the grid, e.g. with a timestep that is
+    # not a whole number
+    def ranks(self, flat):
+        flat = np.asarray(flat, dtype=float).reshape(-1, self.width)
+        ranks = np.full(len(flat), -1, dtype=np.int64)
+        for t in range(len(self.slots)):
+            rows = np.nonzero(flat[:, 0] == t)[0]
+            if len(rows) == 0 or len(self.slots[t]) + len(self.pads[t]) + 1 != self.width:
+                continue
+            inside = np.ones(len(rows), dtype=bool)
+            rank = np.full(len(rows), self.offsets[t], dtype=np.int64)
+            for j in self.pads[t]:
+                inside &= flat[rows, 1 + j] == self.pad
+            for j, (values, positions), stride in zip(self.slots[t], self.sorted_axes[t], self.strides[t]):
+                v = flat[rows, 1 + j]
+                k = np.minimum(np.searchsorted(values, v), len(values) - 1)
+                inside &= values[k] == v
+                rank += positions[k] * stride
+            ranks[rows[inside]] = rank[inside]
+        return ranks
+
+    # index k of the joint action of state s in joint_actions, NO_ACTION for
+    # none and UNSOLVED for the states that were not solved
+    def code(self, s):
+        return int(self.table[self.index(s)])
+
+    # joint action (ah, ar1, ar2) of state s, None where the policy has none
+    # KeyError for the states that were not solved, as for those off the grid
+    def lookup(self, s):
+        k = self.code(s)
+        if k == UNSOLVED:
+            raise KeyError(s)
+        if k == NO_ACTION:
+            return None
+        n1, n2 = len(self.actions_r1), len(self.actions_r2)
+        return (self.actions_h[k // (n1 * n2)], self.actions_r1[k // n2 % n1], self.actions_r2[k % n2])
+
+    # pi[s] is lookup(s) as a list [ah, ar1, ar2], so the table stands in for
+    # the pi of the value_iteration methods
+    def __getitem__(self, s):
+        a = self.lookup(s)
+        return None if a is None else list(a)
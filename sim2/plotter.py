@@ -1,96 +1,173 @@
+'''
+Plots the results of the 2D simulations, which are saved in results.npy.
+By default each figure is shown in turn. With --out the figures are rendered
+without a display (Agg backend) in a process pool, and saved in that folder,
+for instance python plotter.py --out figures --format png pdf
+'''
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from matplotlib import pyplot as plt
-import pickle
-
-def get_data(filename):
-    data = pickle.load(open(filename, 'rb'))
-    return data
-
-def process_file(filename):
-    data = get_data(filename)
-    total_states = 11 * 11 * 9
-    fully_opaque_count = 0.
-    rationally_opaque_count = 0.
-    transparent_count = 0.
-    for key in data:
-        augmented_state, r_opaque, f_opaque = data[key]
-        rationally_opaque_count += r_opaque
-        fully_opaque_count += f_opaque
-        transparent_count += 1 - max([r_opaque, f_opaque])
-    r_perc = rationally_opaque_count / total_states
-    f_perc = fully_opaque_count / total_states
-    t_perc = transparent_count / total_states
-    return (r_perc, f_perc, t_perc)
-
-def plot_file(filename):
-    data = get_data(filename)
-    for key in data:
-        augmented_state, r_opaque, f_opaque = data[key]
-        if r_opaque:
-            plt.plot(augmented_state[1], augmented_state[2], 'bo', markersize=10)
-        if f_opaque:
-            plt.plot(augmented_state[1], augmented_state[2], 'ro', markersize=5)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--out', default=None, help='folder to save the figures in, without a display')
+parser.add_argument('--format', nargs='+', default=['png', 'pdf'], help='file formats of the saved figures')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes that render the saved figures')
+
+# the results and the cache are next to this script
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# all runs are rows of one structured array, see save_results in sbg.py
+# it is memory mapped, so only the rows that are used are read
+def load_results():
+    return np.load(os.path.join(HERE, "results.npy"), mmap_mode='r')
+
+# the rows are sorted by run, so each run is one slice of the store
+# returns the first row of each run and the end of the last one
+def run_bounds(results):
+    model, T, lr = results['model'], results['T'], results['lr']
+    new_run = (model[1:] != model[:-1]) | (T[1:] != T[:-1]) | ~np.isclose(lr[1:], lr[:-1], equal_nan=True)
+    return np.r_[0, np.flatnonzero(new_run) + 1, len(results)]
+
+# rows of one run, lr is None for the bayes human
+def get_data(model, t, lr=None):
+    results = load_results()
+    rows = (results['model'] == model) & (results['T'] == t)
+    rows &= np.isnan(results['lr']) if lr is None else np.isclose(results['lr'], lr)
+    return results[rows]
+
+# fraction of rationally opaque, fully opaque and transparent initial states
+# of every run, summed over the slice of each run at once
+# the fractions are cached in aggregate.npz, and only recomputed once
+# results.npy has changed (its mtime and size are the key)
+def aggregate(cache=os.path.join(HERE, "aggregate.npz")):
+    stat = os.stat(os.path.join(HERE, "results.npy"))
+    key = np.array([stat.st_mtime_ns, stat.st_size])
+    if os.path.exists(cache):
+        with np.load(cache) as f:
+            stats = dict(f)
+        if np.array_equal(stats['key'], key):
+            return stats
+    results = load_results()
+    bounds = run_bounds(results)
+    first, total = bounds[:-1], np.diff(bounds)
+    rational = np.array(results['rational'])
+    full = np.array(results['full'])
+    stats = {
+        'key': key,
+        'model': np.array(results['model'][first]),
+        'T': np.array(results['T'][first]),
+        'lr': np.array(results['lr'][first]),
+        'r_perc': np.add.reduceat(rational, first, dtype=int) / total,
+        'f_perc': np.add.reduceat(full, first, dtype=int) / total,
+        't_perc': np.add.reduceat(~(rational | full), first, dtype=int) / total,
+    }
+    np.savez(cache, **stats)
+    return stats
+
+# one of the fractions of aggregate over the horizons T (rows) and the
+# learning rates LR (columns), or only over T for the bayes human
+# runs that are not saved stay at 0
+def table(stats, perc, model, T, LR=None):
+    T = np.asarray(T)
+    runs = (stats['model'] == model) & np.isin(stats['T'], T)
+    if LR is None:
+        runs &= np.isnan(stats['lr'])
+        Z = np.zeros(len(T))
+        Z[np.searchsorted(T, stats['T'][runs])] = stats[perc][runs]
+        return Z
+    LR = np.asarray(LR)
+    lr = np.round(stats['lr'], 2)
+    runs &= np.isin(lr, LR)
+    Z = np.zeros((len(T), len(LR)))
+    Z[np.searchsorted(T, stats['T'][runs]), np.searchsorted(LR, lr[runs])] = stats[perc][runs]
+    return Z
+
+def plot_file(model, t, lr=None):
+    data = get_data(model, t, lr)
+    r_opaque, f_opaque = data['rational'], data['full']
+    plt.plot(data['state'][r_opaque, 1], data['state'][r_opaque, 2], 'bo', markersize=10)
+    plt.plot(data['state'][f_opaque, 1], data['state'][f_opaque, 2], 'ro', markersize=5)
     plt.axis([-0.1, 2.1, 0, 1])
     plt.show()
 
-# plots for the basic approach
+# horizons and learning rates of the sweeps in the paper
 T = range(5, 16)
 LR = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-Zr = np.zeros((len(T), len(LR)))
-Zf = np.zeros((len(T), len(LR)))
-for idx, t in enumerate(T):
-    for jdx, lr in enumerate(LR):
-        filename = "basic-t-" + str(t) + "-lr-" + str(lr) + ".pkl"
-        (r_perc, f_perc, t_perc) = process_file(filename)
-        Zr[idx, jdx] = r_perc
-        Zf[idx, jdx] = f_perc
-
-# rationally opaque plot
-fig, ax = plt.subplots()
-cmap = ax.pcolormesh(np.transpose(Zr), cmap="Purples", vmin=0.0, vmax=1.0)
-fig.colorbar(cmap)
-plt.show()
-# fully opaque plot
-fig, ax = plt.subplots()
-cmap = ax.pcolormesh(np.transpose(Zf), cmap="Oranges", vmin=0.0, vmax=1.0)
-fig.colorbar(cmap)
-plt.show()
+
+# rationally opaque plot for the basic approach
+def plot_rational(stats):
+    fig, ax = plt.subplots()
+    cmap = ax.pcolormesh(np.transpose(table(stats, 'r_perc', "basic", T, LR)), cmap="Purples", vmin=0.0, vmax=1.0)
+    fig.colorbar(cmap)
+    return fig
+
+# fully opaque plot for the basic approach
+def plot_full(stats):
+    fig, ax = plt.subplots()
+    cmap = ax.pcolormesh(np.transpose(table(stats, 'f_perc', "basic", T, LR)), cmap="Oranges", vmin=0.0, vmax=1.0)
+    fig.colorbar(cmap)
+    return fig
 
 # plots for the bayes human
-T = range(5, 16)
-Zr = np.array([0.] * len(T))
-Zf = np.array([0.] * len(T))
-for idx, t in enumerate(T):
-    filename = "bayes-t-" + str(t) + ".pkl"
-    (r_perc, f_perc, t_perc) = process_file(filename)
-    Zr[idx] = r_perc
-    Zf[idx] = f_perc
-plt.plot(T, Zr)
-plt.plot(T, Zf)
-plt.axis([5, 15, 0, 1.0])
-plt.show()
-
-# plots for the memory human
-T = range(5, 16)
-Zr = np.array([0.] * len(T))
-Zf = np.array([0.] * len(T))
-for idx, t in enumerate(T):
-    filename = "memory-t-" + str(t) + "-lr-0.3.pkl"
-    (r_perc, f_perc, t_perc) = process_file(filename)
-    Zr[idx] = r_perc
-    Zf[idx] = f_perc
-plt.plot(T, Zr)
-plt.plot(T, Zf)
+def plot_bayes(stats):
+    fig, ax = plt.subplots()
+    ax.plot(T, table(stats, 'r_perc', "bayes", T))
+    ax.plot(T, table(stats, 'f_perc', "bayes", T))
+    ax.axis([5, 15, 0, 1.0])
+    return fig
 
-T = range(5, 16)
-Zr = np.array([0.] * len(T))
-Zf = np.array([0.] * len(T))
-for idx, t in enumerate(T):
-    filename = "memory-t-" + str(t) + "-lr-0.7.pkl"
-    (r_perc, f_perc, t_perc) = process_file(filename)
-    Zr[idx] = r_perc
-    Zf[idx] = f_perc
-plt.plot(T, Zr)
-plt.plot(T, Zf)
-plt.axis([5, 15, 0, 1.0])
-plt.show()
+# plots for the memory human, with learning rates 0.3 and 0.7
+def plot_memory(stats):
+    fig, ax = plt.subplots()
+    for lr in [0.3, 0.7]:
+        ax.plot(T, table(stats, 'r_perc', "memory", T, [lr])[:, 0])
+        ax.plot(T, table(stats, 'f_perc', "memory", T, [lr])[:, 0])
+    ax.axis([5, 15, 0, 1.0])
+    return fig
+
+# the figures are independent, so they can be rendered in any order
+FIGURES = {
+    "rational": plot_rational,
+    "full": plot_full,
+    "bayes": plot_bayes,
+    "memory": plot_memory,
+}
+
+# renders one figure and saves it in each format, returns the file names
+def render(name, stats, out, formats):
+    fig = FIGURES[name](stats)
+    paths = []
+    for fmt in formats:
+        paths.append(os.path.join(out, name + "." + fmt))
+        fig.savefig(paths[-1])
+    plt.close(fig)
+    return paths
+
+
+def main(args):
+
+    stats = aggregate()
+
+    # interactive, one figure after the other
+    if args.out is None:
+        for name in FIGURES:
+            FIGURES[name](stats)
+            plt.show()
+        return
+
+    # headless, the workers render with Agg and need no display
+    plt.switch_backend("Agg")
+    os.makedirs(args.out, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=plt.switch_backend, initargs=("Agg",)) as pool:
+        futures = [pool.submit(render, name, stats, args.out, args.format) for name in FIGURES]
+        for future in as_completed(futures):
+            for path in future.result():
+                print("[*] saved: ", path)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -6,19 +6,26 @@ Plotter.py in sim1 folder can be used to plot the results.
 '''
 
 import numpy as np
-import random
 import copy
 from matplotlib import pyplot as plt
 import argparse
-import pickle
+import itertools
+import sbg
 
 
 # by default runs the simulation for 10 timesteps with a learning rate of 0.1
 # get parameters for simulation
 parser = argparse.ArgumentParser()
-parser.add_argument('--t', type=int, default=10, help='time horizon')
-parser.add_argument('--lr', type=float, default=0.1, help='learning rate')
-args = parser.parse_args()
+parser.add_argument('--t', type=int, nargs='+', default=[10], help='time horizon, several horizons are solved once at the largest')
+parser.add_argument('--lr', type=float, nargs='+', default=[0.1], help='learning rate, several learning rates are solved together')
+parser.add_argument('--solver', default="numpy", help='options are numpy, loop and table')
+parser.add_argument('--human', default="random", help='human for full opacity, adversarial (exact search) or random (sampled)')
+parser.add_argument('--lattice', action='store_true', help='run the opacity rollouts on the integer lattice')
+parser.add_argument('--epsilon', type=float, default=None,
+                    help='sample random humans until one reveals the robot or the chance of one is below epsilon')
+parser.add_argument('--confidence', type=float, default=0.95, help='confidence of the --epsilon bound')
+parser.add_argument('--seed', type=int, default=0, help='seed of the random humans, each initial state has its own stream')
+parser.add_argument('--workers', type=int, default=1, help='processes for the full opacity check on the table')
 
 
 # formalize the stochastic bayesian game
@@ -33,12 +40,10 @@ class ExampleSBG:
         self.lr = lr
         # augmented state space
         # (timestep t, state s, belief b)
-        self.states = []
-        for t in range(self.T):
-            for s in np.linspace(0, 2.0, 21):
-                for b in np.linspace(0, 1.0, 11):
-                    augmented_state = (t, round(s,1), round(b,1))
-                    self.states.append(augmented_state)
+        # the states are ranked implicitly instead of stored, see sbg.StateSpace
+        positions = sbg.grid(0, 2.0, 21)
+        beliefs = sbg.grid(0, 1.0, 11)
+        self.states = sbg.StateSpace([(positions, beliefs)] * self.T)
         # action space
         # action space for the confused robot
         self.actions_r1 = [-0.1]
@@ -46,6 +51,12 @@ class ExampleSBG:
         self.actions_r2 = [-0.1, 0.1]
         # action space for the human
         self.actions_h = [-0.1, 0.0, 0.1]
+        # integer lattice for positions and beliefs, see sbg.LatticeGame
+        self.lattice = (sbg.Lattice(0.0, 2.0, 0.1), sbg.Lattice(0.0, 1.0, 0.1))
+        self.action_lattice = self.lattice[0]
+        # the learning rate in grid steps of the beliefs, None when it is not
+        # a whole number of steps, and then only f applies
+        self.lr_steps = self.lattice[-1].steps(self.lr) if self.lattice[-1].is_step(self.lr) else None
 
     # dynamics
     def f(self, s, ah, ar):
@@ -64,6 +75,21 @@ class ExampleSBG:
                 belief = max([0.0, belief - self.lr])
         return (timestep+1, round(state,1), round(belief,1))
 
+    # dynamics on the integer lattice, see sbg.LatticeGame
+    # positions, beliefs and actions are counted in grid steps
+    def f_lattice(self, s, ah, ar):
+        timestep, state, belief = s
+        top = self.lattice[1].n - 1
+        # both human and robot action move the system
+        state = min(self.lattice[0].n - 1, max(0, state + ah + ar))
+        # same belief update as f, in steps of the learning rate
+        if 0 < belief < top:
+            if ar > 0:
+                belief = min(top, belief + self.lr_steps)
+            else:
+                belief = max(0, belief - self.lr_steps)
+        return (timestep+1, state, belief)
+
     # reward function
     def reward(self, s):
         timestep, state = s[0], s[1]
@@ -80,9 +106,13 @@ class ExampleSBG:
     def value_iteration(self):
         V1 = {s: 0 for s in self.states}
         pi = {s: None for s in self.states}
-        for _ in range(self.T+1):
-            V = V1.copy()
-            for s in self.states:
+        # the horizon is finite and f always moves to the next timestep,
+        # so one backward pass over the timestep layers is enough
+        layers = {}
+        for s in self.states:
+            layers.setdefault(s[0], []).append(s)
+        for t in sorted(layers, reverse=True):
+            for s in layers[t]:
                 if s[0] == self.T-1:
                     V1[s] = self.reward(s)
                     continue
@@ -92,29 +122,58 @@ class ExampleSBG:
                         for ar2 in self.actions_r2:
                             s1 = self.f(s, ah, ar1)
                             s2 = self.f(s, ah, ar2)
-                            eV1 = (1-s[2]) * V[s1]
-                            eV2 = s[2] * V[s2]
+                            eV1 = (1-s[2]) * V1[s1]
+                            eV2 = s[2] * V1[s2]
                             if eV1 + eV2 > v_next_max:
                                 v_next_max = eV1 + eV2
                                 pi[s] = [ah, ar1, ar2]
                 V1[s] = self.reward(s) + v_next_max
         return pi, V1
 
+    # same as value_iteration, but backs up each timestep layer at once with numpy
+    # the dynamics do not depend on t, so f is only called on the first layer
+    def value_iteration_vectorized(self):
+        return sbg.value_iteration_vectorized(self, sbg.pure_step(self), belief=2)
+
+    # value_iteration_vectorized for several learning rates at once
+    # the learning rates share the state index and reward tables
+    # returns a dict that maps each learning rate to its pi and V
+    def value_iteration_batch(self, lrs):
+        games = [ExampleSBG(self.T, lr) for lr in lrs]
+        steps = [sbg.pure_step(game) for game in games]
+        return dict(zip(lrs, sbg.value_iteration_batch(games, steps, belief=2)))
+
+    # value_iteration on the successor table, which is compiled once into the
+    # cache folder and memory-mapped on later runs, see sbg.successor_table
+    def value_iteration_table(self):
+        table = sbg.successor_table(self, time_invariant=True)
+        return sbg.value_iteration_table(self, table, belief=2)
+
 
 # generate policies for the random human
-def rand_human_policy(example_sbg, action='none'):
-    pi_h = {}
+# actions are only drawn for the states a rollout visits, see sbg.LazyPolicy
+def rand_human_policy(example_sbg, action='none', rng=None):
     if action == 'none':
-        for state in example_sbg.states:
-            pi_h[state] = random.choice(example_sbg.actions_h)
-    else:
-        for state in example_sbg.states:
-            pi_h[state] = action
-    return pi_h
+        return sbg.LazyPolicy(example_sbg.actions_h, rng=rng)
+    return sbg.LazyPolicy(example_sbg.actions_h, action)
 
 
 # check if an initial state is opaque
-def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000):
+# rng is the numpy Generator of the random humans, see sbg.random_streams
+# dead is shared by the adversarial checks of one pi, see sbg.adversarial_human
+def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000, rng=None, dead=None):
+
+    # on a successor table every rollout step is one array lookup, see sbg.TableGame
+    if isinstance(example_sbg, sbg.TableGame):
+        return example_sbg.check_opaque(init_state, human_type, N,
+                                        fixed=[min(example_sbg.actions_h), max(example_sbg.actions_h), 0.0], rng=rng)
+
+    # the adversarial human tries every human policy at once, see sbg.adversarial_human
+    if human_type == "adversarial":
+        step = lambda s, ah, robot: example_sbg.f(s, ah, pi[s][robot])
+        witness = sbg.adversarial_human(init_state, example_sbg.actions_h, step, example_sbg.T-1,
+                                        lambda s: s[2], dead)
+        return witness is None
 
     # if rational only need one iteration
     # if random we need N iterations to try random policies
@@ -135,7 +194,7 @@ def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000):
             pi_h = rand_human_policy(example_sbg, 0.0)
         else:
             # ok let's try totally random
-            pi_h = rand_human_policy(example_sbg)
+            pi_h = rand_human_policy(example_sbg, rng=rng)
 
         # rollout policy with robot type 1 (confused robot)
         s1 = copy.deepcopy(init_state)
@@ -171,38 +230,100 @@ def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000):
 
 def main(args):
 
-    # get the simulation parameters
-    T = args.t
-    lr = args.lr
-
-    # keep track of which states are opaque
-    opaque_states = {}
-
-    # get optimal policy for human and robot
-    block1d = ExampleSBG(T, lr)
-    pi, V = block1d.value_iteration()
-
-    # check all my states to see if opaque
-    for b0 in [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
-        for s0 in np.linspace(0, 2.0, 21):
-
-            # choose initial augmented state
-            # (timestep t, state s, belief b)
-            augmented_state = (0, round(s0,1), round(b0,1))
-
-            # check if state is rationally / fully opaque
-            rationally_opaque = check_opaque(augmented_state, block1d, pi, human_type="rational", N=1)
-            if rationally_opaque == False:
-                fully_opaque = False
-            else:
-                fully_opaque = check_opaque(augmented_state, block1d, pi, human_type="random", N=100)
-            opaque_states[str(augmented_state)] = (augmented_state, rationally_opaque, fully_opaque)
-
-    # save result
-    pickle.dump(opaque_states, open("sim1/basic-t-" + str(T) + "-lr-" + str(lr) + ".pkl", 'wb'))
-    print("[*] saved: ", "sim1/basic-t-" + str(T) + "-lr-" + str(lr) + ".pkl")
-
-
-
-
-main(args)
+    # number of random humans per initial state, with --epsilon enough of them
+    # to bound the chance of a revealing human, on top of the three fixed
+    # humans of check_opaque, see sbg.random_samples
+    N = 100 if args.epsilon is None else sbg.random_samples(args.epsilon, args.confidence, fixed=3)
+
+    # get optimal policy for human and robot at the largest horizon
+    # f does not depend on t and the reward only fires at t = T-1,
+    # so every shorter horizon is a slice of the same solution
+    # the numpy solver handles all learning rates in one batch
+    T_max = max(args.t)
+    if args.solver == "loop":
+        solutions = {lr: ExampleSBG(T_max, lr).value_iteration() for lr in args.lr}
+    elif args.solver == "table":
+        solutions = {lr: ExampleSBG(T_max, lr).value_iteration_table() for lr in args.lr}
+    else:
+        solutions = ExampleSBG(T_max, args.lr[0]).value_iteration_batch(args.lr)
+
+    # label the rational opacity of every state at once, on the successor
+    # table of the largest horizon, see sbg.TableGame.rational_opaque
+    tables = {lr: sbg.TableGame(ExampleSBG(T_max, lr), solutions[lr][0], belief=2, time_invariant=True)
+              for lr in args.lr}
+    rational = {lr: tables[lr].rational_opaque() for lr in args.lr}
+
+    for lr, T in itertools.product(args.lr, sorted(args.t)):
+        pi_max = solutions[lr][0]
+        block1d = ExampleSBG(T, lr)
+        table = tables[lr].horizon(T)
+        pi = sbg.shift_horizon(pi_max, T_max - T)
+
+        # the table solver also runs the full opacity check on the table, and so
+        # do the random humans, which are then rolled out in one batch, and the
+        # checks that are sharded over several workers
+        if args.solver == "table" or args.human == "random" or args.workers > 1:
+            block1d = table
+        # the opacity rollouts can run on the integer lattice,
+        # then only the initial states are converted
+        elif args.lattice:
+            block1d = sbg.LatticeGame(block1d)
+            pi = block1d.to_lattice_policy(pi)
+
+        # the adversarial checks of this pi share the pairs they rule out, see sbg.adversarial_human
+        dead = set()
+
+        # keep track of which states are opaque
+        opaque_states = {}
+        # and how many random humans each sampled state took
+        samples = {}
+        # each initial state meets the random humans of its own stream
+        rngs = iter(sbg.random_streams(args.seed, 9 * 21))
+        # on the table all initial states are checked in one batch, sharded
+        # over --workers processes, see sbg.parallel_opaque
+        batch = [] if isinstance(block1d, sbg.TableGame) else None
+        batch_rngs = []
+
+        # check all my states to see if opaque
+        for b0 in [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
+            for s0 in np.linspace(0, 2.0, 21):
+
+                # choose initial augmented state
+                # (timestep t, state s, belief b)
+                augmented_state = (0, round(s0,1), round(b0,1))
+                rng = next(rngs)
+                init_state = block1d.to_lattice(augmented_state) if isinstance(block1d, sbg.LatticeGame) else augmented_state
+
+                # check if state is rationally / fully opaque
+                # rational opacity is looked up in the labels of the whole table
+                rationally_opaque = bool(rational[lr][table.index(augmented_state)])
+                if rationally_opaque == False:
+                    fully_opaque = False
+                elif batch is not None:
+                    # decided below, together with the other initial states
+                    fully_opaque = None
+                    batch.append(augmented_state)
+                    batch_rngs.append(rng)
+                else:
+                    fully_opaque = check_opaque(init_state, block1d, pi, human_type=args.human, N=N, rng=rng, dead=dead)
+                opaque_states[str(augmented_state)] = (augmented_state, rationally_opaque, fully_opaque)
+
+        if batch:
+            fixed = [min(table.actions_h), max(table.actions_h), 0.0]
+            full, used = sbg.parallel_opaque(table, batch, args.human, N=N, fixed=fixed, rngs=batch_rngs,
+                                             workers=args.workers)
+            for augmented_state, fully_opaque, n in zip(batch, full, used):
+                opaque_states[str(augmented_state)] = (augmented_state, True, bool(fully_opaque))
+                samples[str(augmented_state)] = int(n)
+
+        # save result, the rows of this run replace the old ones in sim1/results.npy
+        path = sbg.save_results("sim1", "basic", T, lr, opaque_states, samples)
+        print("[*] saved: ", path, "basic t-" + str(T) + " lr-" + str(lr))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    # --epsilon bounds the sampled random humans, the other humans are not sampled
+    if args.epsilon is not None and args.human != "random":
+        parser.error("--epsilon needs --human random")
+    main(args)
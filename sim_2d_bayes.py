@@ -6,18 +6,23 @@ Plotter.py in sim2 folder can be used to plot the results.
 '''
 
 import numpy as np
-import random
 import copy
 from matplotlib import pyplot as plt
 import argparse
-import pickle
+import sbg
 
 
 # by default runs the simulation for 10 timesteps
 # get parameters for simulation
 parser = argparse.ArgumentParser()
-parser.add_argument('--t', type=int, default=10, help="time horizon")
-args = parser.parse_args()
+parser.add_argument('--t', type=int, nargs='+', default=[10], help='time horizon, several horizons are solved once at the largest')
+parser.add_argument('--solver', default="numpy", help='options are numpy and loop')
+parser.add_argument('--human', default="random", help='human for full opacity, adversarial (exact search) or random (sampled)')
+parser.add_argument('--epsilon', type=float, default=None,
+                    help='sample random humans until one reveals the robot or the chance of one is below epsilon')
+parser.add_argument('--confidence', type=float, default=0.95, help='confidence of the --epsilon bound')
+parser.add_argument('--seed', type=int, default=0, help='seed of the random humans, each initial state has its own stream')
+parser.add_argument('--workers', type=int, default=1, help='processes for the full opacity check of the initial states')
 
 # formalize the stochastic bayesian game
 class RobotArmSBG:
@@ -29,13 +34,10 @@ class RobotArmSBG:
         self.T = T
         # augmented state space
         # (timestep t, state x, state y, belief b)
-        self.states = []
-        for t in range(self.T):
-            for sx in np.linspace(0, 1.0, 11):
-                for sy in np.linspace(0, 1.0, 11):
-                    for b in np.linspace(0, 1.0, 11):
-                        augmented_state = (t, round(sx,1), round(sy,1), round(b,1))
-                        self.states.append(augmented_state)
+        # the states are ranked implicitly instead of stored, see sbg.StateSpace
+        positions = sbg.grid(0, 1.0, 11)
+        beliefs = sbg.grid(0, 1.0, 11)
+        self.states = sbg.StateSpace([(positions, positions, beliefs)] * self.T)
         # action space
         # action space for the confused robot
         self.actions_r1 = ((-0.1, 0.), (0., -0.1))
@@ -43,11 +45,18 @@ class RobotArmSBG:
         self.actions_r2 = ((-0.1, 0.), (0., -0.1), (+0.1, 0.), (0., +0.1))
         # action space for the human
         self.actions_h =  ((-0.1, 0.), (0., -0.1), (+0.1, 0.), (0., +0.1))
-        # initialize policy, needed for boltzmann model
-        self.pi = {s: None for s in self.states}
+        # grid steps of the actions, see grid_move
+        self.action_lattice = (sbg.Lattice(0.0, 1.0, 0.1), sbg.Lattice(0.0, 1.0, 0.1))
+        # belief updates of the boltzmann model for every pair of robot types'
+        # actions (ar1, ar2) and action ar the robot takes, see bayes_update
+        self.updates = {(ar1, ar2, ar): self.bayes_update(ar1, ar2, ar)
+                        for ar1 in self.actions_r1 for ar2 in self.actions_r2 for ar in (ar1, ar2)}
 
     # dynamics
-    def f(self, s, ah, ar):
+    # a = (ah, ar1, ar2) is the joint action the team follows in s, the human
+    # compares the robot's action ar with the actions of both types
+    # f only reads its arguments, so it is safe to call in any order or in parallel
+    def f(self, s, ah, ar, a):
         timestep = s[0]
         statex = s[1] + ah[0] + ar[0]
         statey = s[2] + ah[1] + ar[1]
@@ -57,22 +66,47 @@ class RobotArmSBG:
         statey = max([0.0, statey])
         belief = s[3]
         if belief > 0.01 and belief < 0.99:
-            # if both robots take same action,
-            # cannot learn anything, belief stays same
-            if abs(self.pi[s][1][0] - self.pi[s][2][0]) < 0.01 and abs(self.pi[s][1][1] - self.pi[s][2][1]) < 0.01:
-                belief = s[3]
-            # if robot action matches the action of type1
-            # we must be working with type1
-            elif ar[0] < -0.01 or ar[1] < -0.01:
-                belief = 0.0
-            # if robot action matches the action of type2
-            # we must be working with type2
-            elif ar[0] > +0.01 or ar[1] > +0.01:
-                belief = 1.0
-            else:
-                print("we should not be here")
+            key = (a[1], a[2], ar)
+            update = self.updates[key] if key in self.updates else self.bayes_update(*key)
+            if update is not None:
+                belief = update
         return (timestep+1, round(statex,1), round(statey,1), round(belief,1))
 
+    # grid indices of the next states for a joint action, see sbg.grid_successors
+    # positions move by the summed actions and stop at the edges
+    # a belief strictly between 0 and 1 takes the precomputed bayes update
+    def grid_move(self, ah, ar1, ar2):
+        shape = self.states.sizes[0]
+        belief = np.arange(shape[2]).reshape(1, 1, -1)
+        inside = (belief > 0) & (belief < shape[2] - 1)
+        def move(ar):
+            statex = sbg.shift_axis(shape, 0, self.action_lattice[0].steps(ah[0] + ar[0]))
+            statey = sbg.shift_axis(shape, 1, self.action_lattice[1].steps(ah[1] + ar[1]))
+            update = self.updates[ar1, ar2, ar]
+            if update is None:
+                return statex, statey, belief
+            return statex, statey, np.where(inside, int(round(update * (shape[2] - 1))), belief)
+        return move(ar1), move(ar2)
+
+    # new belief when the robot takes ar and the types would take ar1 and ar2
+    # None keeps the belief, this does not depend on the state
+    def bayes_update(self, ar1, ar2, ar):
+        # if both robots take same action,
+        # cannot learn anything, belief stays same
+        if abs(ar1[0] - ar2[0]) < 0.01 and abs(ar1[1] - ar2[1]) < 0.01:
+            return None
+        # if robot action matches the action of type1
+        # we must be working with type1
+        elif ar[0] < -0.01 or ar[1] < -0.01:
+            return 0.0
+        # if robot action matches the action of type2
+        # we must be working with type2
+        elif ar[0] > +0.01 or ar[1] > +0.01:
+            return 1.0
+        else:
+            print("we should not be here")
+            return None
+
     # reward function
     def reward(self, s):
         timestep, statex, statey = s[0], s[1], s[2]
@@ -91,9 +125,13 @@ class RobotArmSBG:
     def value_iteration(self):
         V1 = {s: 0 for s in self.states}
         pi1 = {s: None for s in self.states}
-        for _ in range(self.T+1):
-            V = V1.copy()
-            for s in self.states:
+        # the horizon is finite and f always moves to the next timestep,
+        # so one backward pass over the timestep layers is enough
+        layers = {}
+        for s in self.states:
+            layers.setdefault(s[0], []).append(s)
+        for t in sorted(layers, reverse=True):
+            for s in layers[t]:
                 if s[0] == self.T-1:
                     V1[s] = self.reward(s)
                     continue
@@ -101,33 +139,48 @@ class RobotArmSBG:
                 for ah in self.actions_h:
                     for ar1 in self.actions_r1:
                         for ar2 in self.actions_r2:
-                            self.pi[s] = [ah, ar1, ar2]
-                            s1 = self.f(s, ah, ar1)
-                            s2 = self.f(s, ah, ar2)
-                            eV1 = (1-s[3]) * V[s1]
-                            eV2 = s[3] * V[s2]
+                            s1 = self.f(s, ah, ar1, (ah, ar1, ar2))
+                            s2 = self.f(s, ah, ar2, (ah, ar1, ar2))
+                            eV1 = (1-s[3]) * V1[s1]
+                            eV2 = s[3] * V1[s2]
                             if eV1 + eV2 > v_next_max:
                                 v_next_max = eV1 + eV2
                                 pi1[s] = [ah, ar1, ar2]
                 V1[s] = self.reward(s) + v_next_max
-        self.pi = pi1
         return pi1, V1
 
+    # same as value_iteration, but backs up each timestep layer at once with numpy
+    def value_iteration_vectorized(self):
+        return sbg.value_iteration_grid([self], belief=3)[0]
+
+    # rational opacity of every augmented state under pi, as a mask over the
+    # state ranks, see sbg.rational_opaque
+    def rational_opaque(self, pi):
+        step = lambda s, robot: self.f(s, pi[s][0], pi[s][robot], pi[s])
+        next1, next2 = sbg.policy_successors(self.states, step)
+        return sbg.rational_opaque(self.states, next1, next2, sbg.state_beliefs(self, belief=3))
+
 
 # generate policies for the random human
-def rand_human_policy(example_sbg, action='none'):
-    pi_h = {}
+# actions are only drawn for the states a rollout visits, see sbg.LazyPolicy
+def rand_human_policy(example_sbg, action='none', rng=None):
     if action == 'none':
-        for state in example_sbg.states:
-            pi_h[state] = random.choice(example_sbg.actions_h)
-    else:
-        for state in example_sbg.states:
-            pi_h[state] = action
-    return pi_h
+        return sbg.LazyPolicy(example_sbg.actions_h, rng=rng)
+    return sbg.LazyPolicy(example_sbg.actions_h, action)
 
 
 # check if an initial state is opaque
-def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000):
+# samples, if given, keeps the number of random humans rolled out per state
+# rng is the numpy Generator of the random humans, see sbg.random_streams
+# dead is shared by the adversarial checks of one pi, see sbg.adversarial_human
+def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000, samples=None, rng=None, dead=None):
+
+    # the adversarial human tries every human policy at once, see sbg.adversarial_human
+    if human_type == "adversarial":
+        step = lambda s, ah, robot: example_sbg.f(s, ah, pi[s][robot], pi[s])
+        witness = sbg.adversarial_human(init_state, example_sbg.actions_h, step, example_sbg.T-1,
+                                        lambda s: s[3], dead)
+        return witness is None
 
     # if rational only need one iteration
     # if random we need N iterations to try random policies
@@ -138,7 +191,7 @@ def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000):
     for iteration in range(N):
         # get a random human policy
         # its not clear to me which policies are adversarial...
-        pi_h = rand_human_policy(example_sbg)
+        pi_h = rand_human_policy(example_sbg, rng=rng)
 
         # rollout policy with robot type 1 (confused robot)
         s1 = copy.deepcopy(init_state)
@@ -146,11 +199,11 @@ def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000):
             astar = pi[s1]
             # Rational Human
             if human_type == "rational":
-                s1 = example_sbg.f(s1, astar[0], astar[1])
+                s1 = example_sbg.f(s1, astar[0], astar[1], astar)
             # Random Human
             if human_type == "random":
                 ah = pi_h[s1]
-                s1 = example_sbg.f(s1, ah, astar[1])
+                s1 = example_sbg.f(s1, ah, astar[1], astar)
 
         # rollout policy with robot type 2 (capable robot)
         s2 = copy.deepcopy(init_state)
@@ -158,54 +211,112 @@ def check_opaque(init_state, example_sbg, pi, human_type="rational", N=1000):
             astar = pi[s2]
             # Rational Human
             if human_type == "rational":
-                s2 = example_sbg.f(s2, astar[0], astar[2])
+                s2 = example_sbg.f(s2, astar[0], astar[2], astar)
             # Random Human
             if human_type == "random":
                 ah = pi_h[s2]
-                s2 = example_sbg.f(s2, ah, astar[2])
+                s2 = example_sbg.f(s2, ah, astar[2], astar)
 
         # if beliefs are different then not opaque
         if abs(s1[3] - s2[3]) > 1e-3:
+            if samples is not None:
+                samples[str(init_state)] = iteration + 1
             return False
 
     # if we made it here then it is opaque
+    if samples is not None:
+        samples[str(init_state)] = N
     return True
 
 
 def main(args):
 
-    # get the simulation parameters
-    T = args.t
-
-    # keep track of which states are opaque
-    opaque_states = {}
-
-    # get optimal policy for human and robot
-    block2d = RobotArmSBG(T)
-    pi, V = block2d.value_iteration()
-
-    # check all my states to see if opaque
-    for b0 in [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
-        for sx in np.linspace(0, 1.0, 11):
-            for sy in np.linspace(0, 1.0, 11):
-
-                # choose initial augmented state
-                # (timestep t, state s, belief b)
-                augmented_state = (0, round(sx,1), round(sy,1), round(b0,1))
-
-                # check if state is rationally / fully opaque
-                rationally_opaque = check_opaque(augmented_state, block2d, pi, human_type="rational", N=1)
-                if rationally_opaque == False:
-                    fully_opaque = False
-                else:
-                    fully_opaque = check_opaque(augmented_state, block2d, pi, human_type="random", N=100)
-                opaque_states[str(augmented_state)] = (augmented_state, rationally_opaque, fully_opaque)
-
-
-    # save result
-    pickle.dump(opaque_states, open("sim2/bayes-t-" + str(T) + ".pkl", 'wb'))
-    print("[*] saved: ", "sim2/bayes-t-" + str(T) + ".pkl")
-
+    # number of random humans per initial state, with --epsilon enough of them
+    # to bound the chance of a revealing human, see sbg.random_samples
+    # (there are no fixed humans in 2D, so fixed is 0)
+    N = 100 if args.epsilon is None else sbg.random_samples(args.epsilon, args.confidence)
+
+    # get optimal policy for human and robot at the largest horizon
+    # f does not depend on t and the reward only fires at t = T-1,
+    # so every shorter horizon is a slice of the same solution
+    T_max = max(args.t)
+    block2d = RobotArmSBG(T_max)
+    if args.solver == "loop":
+        pi_max, V_max = block2d.value_iteration()
+    else:
+        pi_max, V_max = block2d.value_iteration_vectorized()
+
+    # label the rational opacity of every state at once, a horizon T game
+    # starts at timestep T_max - T of the largest one
+    rational = block2d.rational_opaque(pi_max)
+    states_max = block2d.states
+
+    # the random humans are rolled out in one batch on a successor table of
+    # the policy, and so are the checks that are sharded over several
+    # workers, see sbg.PolicyGame
+    table_max = None
+    if args.human == "random" or args.workers > 1:
+        table_max = sbg.PolicyGame(block2d, pi_max).table_game(belief=3)
+
+    for T in sorted(args.t):
+        block2d = RobotArmSBG(T)
+        pi = sbg.shift_horizon(pi_max, T_max - T)
+
+        # the adversarial checks of this pi share the pairs they rule out, see sbg.adversarial_human
+        dead = set()
+
+        # keep track of which states are opaque
+        opaque_states = {}
+        # and how many random humans each sampled state took
+        samples = {}
+        # each initial state meets the random humans of its own stream
+        rngs = iter(sbg.random_streams(args.seed, 9 * 11 * 11))
+        # on the table all initial states are checked in one batch, sharded
+        # over --workers processes, see sbg.parallel_opaque
+        table = None if table_max is None else table_max.horizon(T)
+        batch = None if table is None else []
+        batch_rngs = []
+
+        # check all my states to see if opaque
+        for b0 in [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
+            for sx in np.linspace(0, 1.0, 11):
+                for sy in np.linspace(0, 1.0, 11):
 
-main(args)
+                    # choose initial augmented state
+                    # (timestep t, state s, belief b)
+                    augmented_state = (0, round(sx,1), round(sy,1), round(b0,1))
+                    rng = next(rngs)
+
+                    # check if state is rationally / fully opaque
+                    # rational opacity is looked up in the labels of the whole game
+                    rationally_opaque = bool(rational[states_max.index((T_max - T,) + augmented_state[1:])])
+                    if rationally_opaque == False:
+                        fully_opaque = False
+                    elif batch is not None:
+                        # decided below, together with the other initial states
+                        fully_opaque = None
+                        batch.append(augmented_state)
+                        batch_rngs.append(rng)
+                    else:
+                        fully_opaque = check_opaque(augmented_state, block2d, pi, human_type=args.human, N=N, samples=samples, rng=rng, dead=dead)
+                    opaque_states[str(augmented_state)] = (augmented_state, rationally_opaque, fully_opaque)
+
+        if batch:
+            full, used = sbg.parallel_opaque(table, batch, args.human, N=N, rngs=batch_rngs,
+                                             workers=args.workers)
+            for augmented_state, fully_opaque, n in zip(batch, full, used):
+                opaque_states[str(augmented_state)] = (augmented_state, True, bool(fully_opaque))
+                samples[str(augmented_state)] = int(n)
+
+        # save result, the rows of this run replace the old ones in sim2/results.npy
+        path = sbg.save_results("sim2", "bayes", T, None, opaque_states, samples)
+        print("[*] saved: ", path, "bayes t-" + str(T))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    # --epsilon bounds the sampled random humans, the other humans are not sampled
+    if args.epsilon is not None and args.human != "random":
+        parser.error("--epsilon needs --human random")
+    main(args)
 
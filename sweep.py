@@ -0,0 +1,103 @@
+'''
+Code for Section 5 What Conditions Lead to Opaque Robots?
+This code runs the simulations over a grid of time horizons and learning rates.
+Each combination is a separate job in a process pool, and saves its rows in
+the same results store as running the sim script by hand (e.g., sim1/results.npy).
+Combinations that are already saved are skipped.
+Run it from the repository root, like the sim scripts.
+'''
+
+import argparse
+import importlib
+import sbg
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# by default regenerates the 1D basic sweep from the paper
+# for instance, python sweep.py --model memory --dim 2 --lr 0.3 0.7
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', default="basic", help='options are basic, bayes and memory')
+parser.add_argument('--dim', type=int, default=1, help='options are 1 and 2')
+parser.add_argument('--t', type=int, nargs='+', default=list(range(5, 16)), help='time horizons')
+parser.add_argument('--lr', type=float, nargs='+', default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+                    help='learning rates, not used by bayes')
+parser.add_argument('--solver', default="numpy", help='options are numpy, loop and table (table is not for bayes)')
+parser.add_argument('--lattice', action='store_true', help='run the opacity rollouts on the integer lattice')
+parser.add_argument('--human', default="random", help='human for full opacity, adversarial (exact search) or random (sampled)')
+parser.add_argument('--epsilon', type=float, default=None,
+                    help='sample random humans until one reveals the robot or the chance of one is below epsilon')
+parser.add_argument('--confidence', type=float, default=0.95, help='confidence of the --epsilon bound')
+parser.add_argument('--seed', type=int, default=0, help='seed of the random humans, each initial state has its own stream')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+parser.add_argument('--force', action='store_true', help='rerun combinations that are already saved')
+
+
+# sim script for each (model, dimension)
+MODULES = {
+    ("basic", 1): "sim_1d",
+    ("bayes", 1): "sim_1d_bayes",
+    ("memory", 1): "sim_1d_memory",
+    ("basic", 2): "sim_2d",
+    ("bayes", 2): "sim_2d_bayes",
+    ("memory", 2): "sim_2d_memory",
+}
+
+
+# name of a run in the messages, Ts is one horizon or a list of them
+def run_name(model, dim, Ts, lr):
+    T = ",".join(str(T) for T in Ts) if isinstance(Ts, list) else str(Ts)
+    if model == "bayes":
+        return "sim" + str(dim) + " bayes T=" + T
+    return "sim" + str(dim) + " " + model + " T=" + T + " lr=" + str(lr)
+
+
+# run one sim script for a learning rate and all its missing horizons
+# the sim solves once at the largest horizon and shifts the policy to the
+# others, so the horizons of a learning rate share one job
+# workers are the processes of the sim's full opacity check, see sbg.parallel_opaque
+def run(model, dim, Ts, lr, solver, lattice, human, epsilon, confidence, seed, workers):
+    module = importlib.import_module(MODULES[model, dim])
+    module.main(argparse.Namespace(t=Ts, lr=[lr], solver=solver, lattice=lattice, human=human,
+                                   epsilon=epsilon, confidence=confidence, seed=seed, workers=workers))
+    return run_name(model, dim, Ts, lr)
+
+
+def main(args):
+
+    if (args.model, args.dim) not in MODULES:
+        raise ValueError("unknown model " + args.model + " for dimension " + str(args.dim))
+
+    # the bayes model has no learning rate, so it only sweeps the horizon
+    lrs = [None] if args.model == "bayes" else args.lr
+    jobs = []
+    for lr in lrs:
+        Ts = []
+        for T in args.t:
+            if sbg.has_results("sim" + str(args.dim), args.model, T, lr) and not args.force:
+                print("[*] skipped: ", run_name(args.model, args.dim, T, lr))
+                continue
+            Ts.append(T)
+        if Ts:
+            jobs.append((args.model, args.dim, Ts, lr, args.solver, args.lattice, args.human,
+                         args.epsilon, args.confidence, args.seed))
+
+    # there is one job per learning rate, so the cores the jobs leave free
+    # shard the opacity checks inside each job, e.g. the single bayes job
+    # gets all of them
+    # the random humans come from a stream per initial state (see
+    # sbg.random_streams), so the results do not depend on the workers
+    workers = max(1, args.workers // max(1, len(jobs)))
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(run, *job, workers) for job in jobs]
+        for future in as_completed(futures):
+            future.result()
+    print("[*] finished", len(jobs), "jobs")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    # --epsilon bounds the sampled random humans, the other humans are not sampled
+    if args.epsilon is not None and args.human != "random":
+        parser.error("--epsilon needs --human random")
+    main(args)
@@ -10,12 +10,14 @@ import copy
 from matplotlib import pyplot as plt
 import argparse
 import pickle
+import sbg
 
 
 # by default runs the simulation opaque algorithm
 # get parameters for simulation
 parser = argparse.ArgumentParser()
 parser.add_argument('--alg', default="ours", help='which algorithm to run. options are ours and trans')
+parser.add_argument('--export', default=None, help='save the policy to this file, see sbg.PolicyTable and policy_server.py')
 args = parser.parse_args()
 
 
@@ -29,13 +31,8 @@ class ParkingSBG:
         self.T = 4
         # augmented state space
         # (timestep t, state x, state y, belief b)
-        self.states = []
-        for t in range(self.T):
-            for sx in np.linspace(0, 6.0, 7):
-                for sy in np.linspace(-1.2, 1.2, 13):
-                    for b in np.linspace(0, 1.0, 3):
-                        augmented_state = (t, round(sx,1), round(sy,1), round(b,1))
-                        self.states.append(augmented_state)
+        # the states are ranked implicitly instead of stored, see sbg.StateSpace
+        self.states = sbg.StateSpace([(sbg.grid(0, 6.0, 7), sbg.grid(-1.2, 1.2, 13), sbg.grid(0, 1.0, 3))] * self.T)
         # action space
         # action space for the confused robot
         self.actions_r1 = ((1., 0.),)
@@ -43,11 +40,16 @@ class ParkingSBG:
         self.actions_r2 = ((1., 0.), (0., -0.2), (0., 0.2))
         # action space for the human
         self.actions_h =  ((1., 0.), (0., -0.2), (0., 0.2))
-        # initialize policy, needed for boltzmann model
-        self.pi = {s: None for s in self.states}
+        # belief updates of the boltzmann model for every pair of robot types'
+        # actions (ar1, ar2) and action ar the robot takes, see bayes_update
+        self.updates = {(ar1, ar2, ar): self.bayes_update(ar1, ar2, ar)
+                        for ar1 in self.actions_r1 for ar2 in self.actions_r2 for ar in (ar1, ar2)}
 
     # dynamics
-    def f(self, s, ah, ar):
+    # a = (ah, ar1, ar2) is the joint action the team follows in s, the human
+    # compares the robot's action ar with the actions of both types
+    # f only reads its arguments, so it is safe to call in any order or in parallel
+    def f(self, s, ah, ar, a):
         timestep = s[0]
         statex = s[1] + ah[0] + ar[0]
         statey = s[2] + ah[1] + ar[1]
@@ -57,18 +59,26 @@ class ParkingSBG:
         statey = min([+1.2, statey])
         statey = max([-1.2, statey])
         if belief > 0.01 and belief < 0.99:
-            # if both robots take same action,
-            # cannot learn anything, belief stays same
-            if abs(self.pi[s][1][0] - self.pi[s][2][0]) < 0.01 and abs(self.pi[s][1][1] - self.pi[s][2][1]) < 0.01:
-                belief = s[3]
-            # if robot action matches the action of type2
-            # we must be working with type2
-            elif abs(ar[1]) > 0.01:
-                belief = 1.0
-            else:
-                belief = 0.0
+            key = (a[1], a[2], ar)
+            update = self.updates[key] if key in self.updates else self.bayes_update(*key)
+            if update is not None:
+                belief = update
         return (timestep+1, round(statex,1), round(statey,1), round(belief,1))
 
+    # new belief when the robot takes ar and the types would take ar1 and ar2
+    # None keeps the belief, this does not depend on the state
+    def bayes_update(self, ar1, ar2, ar):
+        # if both robots take same action,
+        # cannot learn anything, belief stays same
+        if abs(ar1[0] - ar2[0]) < 0.01 and abs(ar1[1] - ar2[1]) < 0.01:
+            return None
+        # if robot action matches the action of type2
+        # we must be working with type2
+        elif abs(ar[1]) > 0.01:
+            return 1.0
+        else:
+            return 0.0
+
     # reward function
     def reward(self, s):
         timestep, statex, statey = s[0], s[1], s[2]
@@ -91,9 +101,13 @@ class ParkingSBG:
     def value_iteration(self, args):
         V1 = {s: 0 for s in self.states}
         pi1 = {s: None for s in self.states}
-        for _ in range(self.T+1):
-            V = V1.copy()
-            for s in self.states:
+        # the horizon is finite and f always moves to the next timestep,
+        # so one backward pass over the timestep layers is enough
+        layers = {}
+        for s in self.states:
+            layers.setdefault(s[0], []).append(s)
+        for t in sorted(layers, reverse=True):
+            for s in layers[t]:
                 if s[0] == self.T-1:
                     V1[s] = self.reward(s)
                     continue
@@ -101,18 +115,16 @@ class ParkingSBG:
                 for ah in self.actions_h:
                     for ar1 in self.actions_r1:
                         for ar2 in self.actions_r2:
-                            self.pi[s] = [ah, ar1, ar2]
-                            s1 = self.f(s, ah, ar1)
-                            s2 = self.f(s, ah, ar2)
-                            eV1 = (1-s[3]) * V[s1]
-                            eV2 = s[3] * V[s2]
+                            s1 = self.f(s, ah, ar1, (ah, ar1, ar2))
+                            s2 = self.f(s, ah, ar2, (ah, ar1, ar2))
+                            eV1 = (1-s[3]) * V1[s1]
+                            eV2 = s[3] * V1[s2]
                             if args.alg == "trans":
                                 eV1 += 1.0 * self.bonus_reward([ah, ar1, ar2])
                             if eV1 + eV2 > v_next_max:
                                 v_next_max = eV1 + eV2
                                 pi1[s] = [ah, ar1, ar2]
                 V1[s] = self.reward(s) + v_next_max
-        self.pi = pi1
         return pi1, V1
 
 
@@ -121,6 +133,9 @@ def main(args):
     # get optimal policy for human and robot
     env = ParkingSBG()
     pi, V = env.value_iteration(args)
+    if args.export is not None:
+        sbg.export_policy(env, pi, args.export)
+        print("[*] saved: ", args.export)
 
     # choose initial augmented state
     # (timestep t, state s, belief b)
@@ -131,7 +146,7 @@ def main(args):
     print("[*] type 1")
     for t in range(env.T-1):
         astar = pi[s1]
-        s1 = env.f(s1, astar[0], astar[1])
+        s1 = env.f(s1, astar[0], astar[1], astar)
         print(s1, astar[1], astar[2])
 
     # rollout policy with robot type 1
@@ -139,7 +154,7 @@ def main(args):
     print("[*] type 2")
     for t in range(env.T-1):
         astar = pi[s2]
-        s2 = env.f(s2, astar[0], astar[2])
+        s2 = env.f(s2, astar[0], astar[2], astar)
         print(s2, astar[1], astar[2])
 
 main(args)
@@ -10,11 +10,13 @@ import copy
 from matplotlib import pyplot as plt
 import argparse
 import pickle
+import sbg
 
 # by default runs the simulation opaque algorithm
 # get parameters for simulation
 parser = argparse.ArgumentParser()
 parser.add_argument('--alg', default="ours", help='which algorithm to run. options are ours and trans')
+parser.add_argument('--export', default=None, help='save the policy to this file, see sbg.PolicyTable and policy_server.py')
 args = parser.parse_args()
 
 
@@ -28,13 +30,8 @@ class TurningSBG:
         self.T = 4
         # augmented state space
         # (timestep t, state x, state y, belief b)
-        self.states = []
-        for t in range(self.T):
-            for angle in np.linspace(-3.0, 3.0, 13):
-                for speed in np.linspace(0, 6.0, 7):
-                    for b in np.linspace(0, 1.0, 3):
-                        augmented_state = (t, round(angle,1), round(speed,1), round(b,1))
-                        self.states.append(augmented_state)
+        # the states are ranked implicitly instead of stored, see sbg.StateSpace
+        self.states = sbg.StateSpace([(sbg.grid(-3.0, 3.0, 13), sbg.grid(0, 6.0, 7), sbg.grid(0, 1.0, 3))] * self.T)
         # action space
         # action space for the confused robot
         self.actions_r1 = ((0., 1.),)
@@ -42,11 +39,16 @@ class TurningSBG:
         self.actions_r2 = ((0., 1.), (-0.5, 0.), (+0.5, 0.))
         # action space for the human
         self.actions_h =  ((0., 1.), (-0.5, 0.), (+0.5, 0.))
-        # initialize policy, needed for boltzmann model
-        self.pi = {s: None for s in self.states}
+        # belief updates of the boltzmann model for every pair of robot types'
+        # actions (ar1, ar2) and action ar the robot takes, see bayes_update
+        self.updates = {(ar1, ar2, ar): self.bayes_update(ar1, ar2, ar)
+                        for ar1 in self.actions_r1 for ar2 in self.actions_r2 for ar in (ar1, ar2)}
 
     # dynamics
-    def f(self, s, ah, ar):
+    # a = (ah, ar1, ar2) is the joint action the team follows in s, the human
+    # compares the robot's action ar with the actions of both types
+    # f only reads its arguments, so it is safe to call in any order or in parallel
+    def f(self, s, ah, ar, a):
         timestep = s[0]
         angle = s[1] + ah[0] + ar[0]
         speed = s[2] + ah[1] + ar[1]
@@ -56,18 +58,26 @@ class TurningSBG:
         speed = min([+6.0, speed])
         speed = max([-6.0, speed])
         if belief > 0.01 and belief < 0.99:
-            # if both robots take same action,
-            # cannot learn anything, belief stays same
-            if abs(self.pi[s][1][0] - self.pi[s][2][0]) < 0.01 and abs(self.pi[s][1][1] - self.pi[s][2][1]) < 0.01:
-                belief = s[3]
-            # if robot action matches the action of type2
-            # we must be working with type2
-            elif abs(ar[0]) > 0.01:
-                belief = 1.0
-            else:
-                belief = 0.0
+            key = (a[1], a[2], ar)
+            update = self.updates[key] if key in self.updates else self.bayes_update(*key)
+            if update is not None:
+                belief = update
         return (timestep+1, round(angle,1), round(speed,1), round(belief,1))
 
+    # new belief when the robot takes ar and the types would take ar1 and ar2
+    # None keeps the belief, this does not depend on the state
+    def bayes_update(self, ar1, ar2, ar):
+        # if both robots take same action,
+        # cannot learn anything, belief stays same
+        if abs(ar1[0] - ar2[0]) < 0.01 and abs(ar1[1] - ar2[1]) < 0.01:
+            return None
+        # if robot action matches the action of type2
+        # we must be working with type2
+        elif abs(ar[0]) > 0.01:
+            return 1.0
+        else:
+            return 0.0
+
     # reward function
     def reward(self, s):
         timestep, angle, speed = s[0], s[1], s[2]
@@ -88,9 +98,13 @@ class TurningSBG:
     def value_iteration(self, args):
         V1 = {s: 0 for s in self.states}
         pi1 = {s: None for s in self.states}
-        for _ in range(self.T+1):
-            V = V1.copy()
-            for s in self.states:
+        # the horizon is finite and f always moves to the next timestep,
+        # so one backward pass over the timestep layers is enough
+        layers = {}
+        for s in self.states:
+            layers.setdefault(s[0], []).append(s)
+        for t in sorted(layers, reverse=True):
+            for s in layers[t]:
                 if s[0] == self.T-1:
                     V1[s] = self.reward(s)
                     continue
@@ -98,18 +112,16 @@ class TurningSBG:
                 for ah in self.actions_h:
                     for ar1 in self.actions_r1:
                         for ar2 in self.actions_r2:
-                            self.pi[s] = [ah, ar1, ar2]
-                            s1 = self.f(s, ah, ar1)
-                            s2 = self.f(s, ah, ar2)
-                            eV1 = (1-s[3]) * V[s1]
-                            eV2 = s[3] * V[s2]
+                            s1 = self.f(s, ah, ar1, (ah, ar1, ar2))
+                            s2 = self.f(s, ah, ar2, (ah, ar1, ar2))
+                            eV1 = (1-s[3]) * V1[s1]
+                            eV2 = s[3] * V1[s2]
                             if args.alg == "trans":
                                 eV1 += 1.0 * self.bonus_reward([ah, ar1, ar2])
                             if eV1 + eV2 > v_next_max:
                                 v_next_max = eV1 + eV2
                                 pi1[s] = [ah, ar1, ar2]
                 V1[s] = self.reward(s) + v_next_max
-        self.pi = pi1
         return pi1, V1
 
 
@@ -118,6 +130,9 @@ def main(args):
     # get optimal policy for human and robot
     env = TurningSBG()
     pi, V = env.value_iteration(args)
+    if args.export is not None:
+        sbg.export_policy(env, pi, args.export)
+        print("[*] saved: ", args.export)
 
     # choose initial augmented state
     # (timestep t, state s, belief b)
@@ -128,7 +143,7 @@ def main(args):
     print("[*] type 1")
     for t in range(env.T-1):
         astar = pi[s1]
-        s1 = env.f(s1, astar[0], astar[1])
+        s1 = env.f(s1, astar[0], astar[1], astar)
         print(s1, astar[1], astar[2])
 
     # rollout policy with robot type 1
@@ -136,7 +151,7 @@ def main(args):
     print("[*] type 2")
     for t in range(env.T-1):
         astar = pi[s2]
-        s2 = env.f(s2, astar[0], astar[2])
+        s2 = env.f(s2, astar[0], astar[2], astar)
         print(s2, astar[1], astar[2])
 
 
@@ -4,25 +4,40 @@ This code runs the simulation for the study in 6.2
 '''
 
 import numpy as np
-import random
 import copy
+import math
+import os
+import tempfile
 from matplotlib import pyplot as plt
 import argparse
-import pickle
+import sbg
 
 # by default runs the simulation opaque algorithm with learning rate 0.5
 # get parameters for simulation
 parser = argparse.ArgumentParser()
 parser.add_argument('--alg', default="ours", help='which algorithm to run. options are ours and trans')
 parser.add_argument('--lr', type=float, default=0.5, help='learning rate for the simulation') 
+parser.add_argument('--solver', default="reachable", help='options are reachable, additive and loop (every tower at every belief)')
+parser.add_argument('--t', type=int, default=3, help='rounds of placing blocks, long towers only with --solver additive')
+parser.add_argument('--blocks', type=int, default=4, help='blocks the human and the capable robot choose from')
+parser.add_argument('--export', default=None, help='save the policy for the robot arm to this file, see sbg.PolicyTable')
 args = parser.parse_args()
 
+# most towers the loop and the reachable solvers may hold
+# the reachable solver holds two layers of towers at a time, as python
+# tuples, and the loop solver every tower at every belief
+MAX_STATES = 10**6
+
 
 # formalize the stochastic bayesian game
 class TowerSBG:
 
      # initialization
-    def __init__(self, T, lr):
+    # T rounds of placing blocks, in each round the human and the robot
+    # both put one block on the tower
+    # blocks are the block types of the human and the capable robot, the
+    # confused robot only knows the first confused of them
+    def __init__(self, T, lr, blocks=4, confused=2):
 
         # time horizon
         self.T = T
@@ -30,82 +45,81 @@ class TowerSBG:
         self.lr = lr
         # augmented state space
         # (timestep t, state s, belief b)
-        self.states = []
-        for belief in np.linspace(0, 1.0, 11):
-            self.states.append((0, (-1, -1, -1, -1, -1, -1), round(belief, 1)))
-        for block1 in range(6):
-            for block2 in range(6):
-                for belief in np.linspace(0, 1.0, 11):
-                    tower = (block1, block2, -1, -1, -1, -1)
-                    self.states.append((1, tower, round(belief, 1)))
-        for block1 in range(6):
-            for block2 in range(6):
-                for block3 in range(6):
-                    for block4 in range(6):
-                        for belief in np.linspace(0, 1.0, 11):
-                            tower = (block1, block2, block3, block4, -1, -1)
-                            self.states.append((2, tower, round(belief, 1)))
-        for block1 in range(6):
-            for block2 in range(6):
-                for block3 in range(6):
-                    for block4 in range(6):
-                        for block5 in range(6):
-                             for block6 in range(6):
-                                for belief in np.linspace(0, 1.0, 11):
-                                    tower = (block1, block2, block3, block4, block5, block6)
-                                    self.states.append((3, tower, round(belief, 1)))
-        # some good use of for loops with keep this scaling up
-        # currently the tower can only hold a max of six blocks
+        # after t placement rounds the first 2t slots of the tower hold blocks
+        # the states are ranked implicitly instead of stored, see sbg.StateSpace
+        beliefs = sbg.grid(0, 1.0, 11)
+        layers = [(tuple(range(blocks)),) * 2 * t + (beliefs,) for t in range(T+1)]
+        self.states = sbg.StateSpace(layers, pack=self.pack_state, unpack=self.unpack_state)
+        # the tower holds 2T blocks
 
         # action space
-        # 4 blocks to choose from for capable, 2 for confused
+        # 4 blocks to choose from for capable, 2 for confused in the study
         # action space for the confused robot
-        self.actions_r1 = range(2) 
+        self.actions_r1 = range(confused) 
         # action space for the capable robot
-        self.actions_r2 = range(4) 
+        self.actions_r2 = range(blocks) 
         # action space for the human
-        self.actions_h = range(4)
+        self.actions_h = range(blocks)
+        # initial state of the study, the empty tower at belief 0.5
+        self.init_states = [(0, (-1,) * 2 * T, 0.5)]
+
+    # convert between states and the flat coordinates of the StateSpace
+    # (placed blocks..., belief), the empty slots hold -1
+    def pack_state(self, t, coords):
+        tower = coords[:-1] + (-1,) * (2*self.T + 1 - len(coords))
+        return (t, tower, coords[-1])
+
+    def unpack_state(self, s):
+        t, tower, belief = s
+        if tower[2*t:] != (-1,) * (2*self.T - 2*t):
+            raise KeyError(s)
+        return (t, tower[:2*t] + (belief,))
+
+    # number of towers reachable from the initial states in the first rounds
+    # every pair of blocks makes a new tower, and the belief only depends on
+    # the tower, so a layer holds at most all pairs or all towers at every
+    # belief of the grid
+    def reachable_states(self, rounds):
+        pairs = len(self.actions_h) * len(sbg.robot_actions(self))
+        layers = [math.prod(len(axis) for axis in self.states.layers[t]) for t in range(rounds+1)]
+        return sum(min(len(self.init_states) * pairs**t, layers[t]) for t in range(rounds+1))
 
     # dynamics
+    # in round t the human and the robot fill slots 2t and 2t+1
     def f(self, s, ah, ar):
-        timestep = s[0]
-        if timestep == 0:
-            state = (ah, ar, -1, -1, -1, -1)
-        if timestep == 1:
-            state = (s[1][0], s[1][1], ah, ar, -1, -1)
-        if timestep == 2:
-            state = (s[1][0], s[1][1], s[1][2], s[1][3], ah, ar)
-        belief = s[2]
+        timestep, tower = s[0], s[1]
+        state = tower[:2*timestep] + (ah, ar) + tower[2*timestep+2:]
+        return (timestep+1, state, self.update_belief(s[2], ar))
+
+    # the belief only depends on the robot's block
+    def update_belief(self, belief, ar):
         if belief > 0.01 and belief < 0.99:
             if ar >= 3:
                 belief = min([0.9, belief + self.lr])
             else:
                 belief = max([0.1, belief - self.lr])
-        return (timestep+1, state, round(belief,1))
+        return round(belief,1)
+
+    # reward of one pair of blocks, placed in the same round
+    def pair_reward(self, block1, block2):
+        matching_bonus = 5.0 # bonus for choosing the same block
+        height_bonus = 1.0  # bonus for choosing a big block
+        if block1 == block2:
+            reward = +matching_bonus
+        else:
+            reward = -matching_bonus
+        if block1 > 1:
+            reward += height_bonus
+        if block2 > 1:
+            reward += height_bonus
+        return reward
 
     # reward function
+    # the pairs placed so far add up
     def reward(self, s):
         timestep, state = s[0], s[1]
-        matching_bonus = 5.0 # bonus for choosing the same block
-        height_bonus = 1.0  # bonus for choosing a big block
-        rewards = [0, 0, 0]
-        for idx, pair in enumerate(((0, 1), (2, 3), (4, 5))):
-            if state[pair[0]] == state[pair[1]]:
-                rewards[idx] = +matching_bonus
-            else:
-                rewards[idx] = -matching_bonus
-            if state[pair[0]] > 1:
-                rewards[idx] += height_bonus
-            if state[pair[1]] > 1:
-                rewards[idx] += height_bonus
-        if timestep == 0:
-            return 0.
-        if timestep == 1:
-            return rewards[0]
-        if timestep == 2:
-            return rewards[0] + rewards[1]
-        if timestep == 3:
-            return rewards[0] + rewards[1] + rewards[2]
+        rewards = [self.pair_reward(state[2*k], state[2*k+1]) for k in range(timestep)]
+        return sum(rewards, 0.)
 
     # bonus reward for transparency
     def bonus_reward(self, a):
@@ -119,9 +133,13 @@ class TowerSBG:
     def value_iteration(self, args):
         V1 = {s: 0 for s in self.states}
         pi = {s: None for s in self.states}
-        for _ in range(self.T+1):
-            V = V1.copy()
-            for s in self.states:
+        # the horizon is finite and f always moves to the next timestep,
+        # so one backward pass over the timestep layers is enough
+        layers = {}
+        for s in self.states:
+            layers.setdefault(s[0], []).append(s)
+        for t in sorted(layers, reverse=True):
+            for s in layers[t]:
                 if s[0] >= self.T:
                     V1[s] = self.reward(s)
                     continue
@@ -131,8 +149,8 @@ class TowerSBG:
                         for ar2 in self.actions_r2:
                             s1 = self.f(s, ah, ar1)
                             s2 = self.f(s, ah, ar2)
-                            eV1 = (1-s[2]) * V[s1]
-                            eV2 = s[2] * V[s2]
+                            eV1 = (1-s[2]) * V1[s1]
+                            eV2 = s[2] * V1[s2]
                             if args.alg == "trans":
                                 eV1 += 1.0 * self.bonus_reward([ah, ar1, ar2])
                             if eV1 + eV2 > v_next_max:
@@ -140,53 +158,145 @@ class TowerSBG:
                                 pi[s] = [ah, ar1, ar2]
                 V1[s] = self.reward(s) + v_next_max 
         return pi, V1
+
+    # same as value_iteration, but only for the states reachable from the
+    # initial states, see sbg.solve_reachable
+    # the belief only takes a few values, so this is a small part of
+    # self.states, but it still grows as (blocks * blocks)^T
+    # the layers are solved one at a time and written straight to the policy
+    # file at path, see sbg.export_policy, so only two layers of towers are
+    # held at once
+    # returns the policy file, which is looked up like pi, see sbg.PolicyTable
+    def value_iteration_reachable(self, args, path):
+        bonus = None
+        if args.alg == "trans":
+            bonus = [1.0 * self.bonus_reward(a) for a in sbg.joint_actions(self)]
+        layers = sbg.solve_reachable(self, self.init_states, self.T, belief=2, bonus=bonus)
+        sbg.export_policy(self, ((s, a) for states, actions, _ in layers for s, a in zip(states, actions)), path, pad=-1)
+        return sbg.PolicyTable(path)
+
+    # the reward adds up over the rounds, and neither the dynamics of the
+    # belief nor the reward of a round depend on the earlier blocks, so
+    # (timestep, reward so far, belief) is a sufficient statistic of a state
+    def summarize(self, s):
+        return (s[0], self.reward(s), s[2])
+
+    def f_summary(self, c, ah, ar):
+        return (c[0]+1, c[1] + self.pair_reward(ah, ar), self.update_belief(c[2], ar))
+
+    def summary_reward(self, c):
+        return c[1]
+
+    # value_iteration on the summaries, see sbg.SummaryGame
+    # the summary is checked on the towers of as many rounds as the other
+    # solvers could hold (see MAX_STATES), and then solves any number of
+    # rounds, since it does not hold the tower
+    # (8 to 12 rounds take well under a second)
+    # returns the summary game, and pi and V keyed by the summaries
+    def value_iteration_additive(self, args):
+        game = sbg.SummaryGame(self, self.summarize, self.f_summary, self.summary_reward)
+        rounds = max([t for t in range(1, self.T+1) if self.reachable_states(t) <= MAX_STATES], default=1)
+        # the layers are streamed, the last one only has terminal states
+        for layer in sbg.reachable(self, self.init_states, rounds - 1):
+            game.check(layer)
+        bonus = None
+        if args.alg == "trans":
+            bonus = [1.0 * self.bonus_reward(a) for a in sbg.joint_actions(self)]
+        init_states = [self.summarize(s) for s in self.init_states]
+        pi, V = sbg.value_iteration_reachable(game, init_states, self.T, belief=2, bonus=bonus)
+        return game, pi, V
     
 def main(args):
 
     # get the simulation parameters
-    T = 3
+    T = args.t
     lr = args.lr 
 
     # get optimal policy for human and robot
-    tower_sbg = TowerSBG(T, lr)
-    pi, V = tower_sbg.value_iteration(args)
+    # the additive solver works on summaries of the states, which are also
+    # what the rollouts below step through
+    # the other solvers hold towers, which grow as (blocks * blocks)^T,
+    # so they only solve as many rounds as MAX_STATES towers allow
+    # the robot looks up the towers, so the summaries of the additive solver
+    # cannot be saved
+    tower_sbg = TowerSBG(T, lr, blocks=args.blocks)
+    game = tower_sbg
+    held = len(tower_sbg.states) if args.solver == "loop" else tower_sbg.reachable_states(T)
+    if args.solver == "additive":
+        if args.export is not None:
+            raise ValueError("the policy of the additive solver is over summaries, use --solver reachable to export")
+        game, pi, V = tower_sbg.value_iteration_additive(args)
+    elif held > MAX_STATES:
+        raise ValueError("--t " + str(T) + " with --blocks " + str(args.blocks) + " holds " + str(held)
+                         + " towers, more than " + str(MAX_STATES) + ", use --solver additive")
+    elif args.solver == "loop":
+        pi, V = tower_sbg.value_iteration(args)
+        if args.export is not None:
+            sbg.export_policy(tower_sbg, pi, args.export, pad=-1)
+    else:
+        # the policy is written to the policy file as it is solved, without
+        # --export to a temporary one for the rollouts below
+        if args.export is not None:
+            path = args.export
+        else:
+            handle, path = tempfile.mkstemp(suffix=".bin")
+            os.close(handle)
+        pi = tower_sbg.value_iteration_reachable(args, path)
 
     ## save pi for use on actual robot arm
     ## save result
-    # pickle.dump(pi, open("res/pi-b4-t-" + str(T) + "-lr-" + str(args.lr) + args.alg +  ".pkl", 'wb'))
-    # print("[*] saved: ", "res/pi-b4-t-" + str(T) + "-lr-" + str(args.lr) + args.alg +  ".pkl")
+    # e.g. --export res/pi-b4-t-3-lr-0.5ours.bin
+    if args.export is not None:
+        print("[*] saved: ", args.export)
     
 
     # everything below is just for testing
 
     # timestep 0, empty tower, initial belief
-    init_state = (0, (-1, -1, -1, -1, -1, -1), 0.5)
+    init_state = tower_sbg.init_states[0]
+    if args.solver == "additive":
+        init_state = game.summarize(init_state)
     
     # rollout policy with robot type 1 (confused robot)
     s1 = copy.deepcopy(init_state)
-    print(tower_sbg.reward(s1))
+    print(game.reward(s1))
     print("[*] type 1 - Confused Robot")
-    for t in range(tower_sbg.T):
+    for t in range(game.T):
         astar = pi[s1]
         print(s1, astar)
-        print(tower_sbg.reward(s1))
+        print(game.reward(s1))
         # Rational Human
-        s1 = tower_sbg.f(s1, astar[0], astar[1])
+        s1 = game.f(s1, astar[0], astar[1])
     print(s1)
-    print(tower_sbg.reward(s1))
+    print(game.reward(s1))
 
     # rollout policy with robot type 2 (capable robot)
     s2 = copy.deepcopy(init_state)
-    print(tower_sbg.reward(s2))
+    print(game.reward(s2))
     print("[*] type 2 - Capable Robot")
-    for t in range(tower_sbg.T):
+    for t in range(game.T):
         astar = pi[s2]
         print(s2, astar)
-        print(tower_sbg.reward(s2))
+        print(game.reward(s2))
         # Rational Human
-        s2 = tower_sbg.f(s2, astar[0], astar[2])
+        s2 = game.f(s2, astar[0], astar[2])
     print(s2)
-    print(tower_sbg.reward(s2))
+    print(game.reward(s2))
+
+    # the reachable solver only solves the towers it reaches, the others are
+    # on the grid of the policy file but unsolved, so looking one up raises
+    # KeyError (the belief never drops below 0.1)
+    if args.solver == "reachable":
+        unreachable = (1, (0, 0) + (-1,) * (2*T - 2), 0.0)
+        try:
+            pi[unreachable]
+        except KeyError:
+            print("[*] unsolved: ", unreachable)
+        else:
+            raise ValueError("unreachable tower " + str(unreachable) + " has a policy")
+
+    if args.solver == "reachable" and args.export is None:
+        os.remove(path)
 
 
 